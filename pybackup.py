@@ -1,50 +1,143 @@
 #!/bin/env python3.9
+import array
 import atexit
+import collections
+import contextlib
 import datetime
+import json
+import errno
+import fcntl
 import getopt
+import hashlib
 import logging
+import multiprocessing
 import os
 import platform
+import queue
 import re
+import signal
 import sqlite3
 import stat
+import struct
 import subprocess
 import sys
+import tarfile
 import threading
 import time
+from concurrent.futures import Future
+from concurrent.futures.process import ProcessPoolExecutor
 from concurrent.futures.thread import ThreadPoolExecutor
-from itertools import count
+from itertools import count, repeat
 from typing import BinaryIO
 
 import jinja2
 import yaml
-from setuptools.msvc import msvc14_gen_lib_options
-from twisted.python.log import msg
 
 HEADER_SZ = 512
 config = {}
 counts = {
     'backed_up': 0,
+    'chunks': 0,
+    'bytes_in': 0,
+    'bytes_out': 0,
     'cyclic': 0,
+    'deduplicated': 0,
     'excluded': 0,
+    'filled': 0,
     'incremental': 0,
+    'link_bytes': 0,
+    'linked': 0,
     'permissions': 0,
+    'pruned': 0,
+    'ratio': 0,
+    'reclaimable': [],
     'removed': 0,
     'same_old': 0,
+    'stages': [],
+    'throttled': 0,
+    'throughput': 0,
+    'lowest_rate': 0,
     'too_recent': 0,
+    'unchanged': 0,
+    'volumes': [],
+    'walk': '',
 }
 db_conn: sqlite3.Connection
 """Database connection """
-db_lock = threading.Lock()
 defaultCfg = """
 ---
 # default configuration
 log: pybackup.log
 db: /tmp/pybackup.db
+# sqlite journal mode and synchronous level for the catalog
+db_journal: wal
+db_synchronous: normal
+# load the catalog into memory for the incremental scan, up to this size
+db_preload: false
+db_preload_memory: 256M
+# catalog updates are written in transactions of this many rows or after this many seconds
+db_batch: 5000
+db_interval: 5
+# threads listing directories ahead of the scan
+scan_threads: 8
 min_age: 300
 max_target_size: 500m
-target: /tmp/backup-%h-%t.tar.enc.xz
+# a run continues on further volumes while new or changed files are left, up to this many volumes
+# and this many bytes in all volumes together, 0 for no limit
+max_volumes: 1
+max_run_size: 0
+# volumes written at the same time, each with its own pipeline
+pipelines: 1
+# %h host, %t time, %n volume number, %z suffix of the compression
+target: /tmp/backup-%h-%t.tar%z.gpg
 key: topsecret
+# compression before encryption: xz, zstd or none; threads 0 uses all cores
+compression: xz
+compression_level: 6
+compression_threads: 0
+# compression works on blocks of this size, smaller blocks let the volume get closer to max_target_size
+compression_block: 8M
+# volumes with less than this part of their bytes still live are emptied first by the cyclic backup
+compact_below: 0.5
+# hash changed files of at least hash_min_size in hash_workers processes (0 for all cores),
+# to skip those with the same content as before and store copies of archived files only once
+hashing: false
+hash_workers: 0
+hash_min_size: 64K
+# files of at least chunk_above bytes are archived in chunks of chunk_size, unchanged chunks are not archived again;
+# needs archiver python, 0 for off
+chunk_above: 0
+chunk_size: 64M
+# files are fed to the archiver in batches of read_window, sorted by inode or, with read_order fiemap, by their
+# place on disk; files up to readahead_size are prefetched meanwhile; 0 keeps the scan order
+read_window: 0
+read_order: inode
+readahead_size: 1M
+# files with fewer blocks allocated than their size are archived without their holes
+sparse: false
+# with pywatch.py running, the incremental backup only lists the directories it journaled; the whole tree is walked
+# when the journal may have missed changes and every full_walk_interval seconds
+journal: false
+full_walk_interval: 604800
+# seconds between the heartbeats of pywatch.py, it counts as stopped after three missed ones
+watch_beat: 10
+# volumes are written as frames of this many archive bytes, each compressed and encrypted on its own, so pyrestore
+# reads only the frames holding the files it restores; needs archiver python, 0 for one stream
+frame_size: 0
+# run at the lowest CPU and the idle I/O priority, dropping the files read and the volumes written from the page cache
+low_impact: false
+# bytes per second the archivers read at most, 0 for no limit
+io_limit: 0
+# the archivers slow down while tasks stall on I/O for more than this percentage of the time (avg10 of
+# /proc/pressure/io) or the load average per core is above max_load; 0 for no limit
+max_io_pressure: 0
+max_load: 0
+# gnutar runs tar as a subprocess, python writes the archive in process
+archiver: gnutar
+# timings of the phases and stages of the run as JSON, and as a file for the textfile collector of the Prometheus
+# node exporter (a directory given by --collector.textfile.directory, name ending in .prom); empty for none
+metrics_json: ''
+metrics_prom: ''
 exclude_flag: ".bkexclude"
 email:
     server: localhost
@@ -59,14 +152,41 @@ exclude: []
 resultT: |
   The counts are:
 
+                scan: {{ walk }}
      backed up files:{{ "%7d" | format(backed_up) }}
          incremental:{{ "%7d" | format(incremental) }}
               cyclic:{{ "%7d" | format(cyclic) }}
     skipped 2 recent:{{ "%7d" | format(too_recent) }}
      skipped as same:{{ "%7d" | format(same_old) }}
+   unchanged content:{{ "%7d" | format(unchanged) }}
+          duplicates:{{ "%7d" | format(deduplicated) }}
+          hard links:{{ "%7d" | format(linked) }} ({{ "%.1f" | format(link_bytes / 1000000) }} MB not stored again)
+     chunks archived:{{ "%7d" | format(chunks) }}
         skipped flag:{{ "%7d" | format(excluded) }}
+         pruned dirs:{{ "%7d" | format(pruned) }}
        skipped perm.:{{ "%7d" | format(permissions) }}
      removed from db:{{ "%7d" | format(removed) }}
+       data archived:{{ "%7.1f" | format(bytes_in / 1000000) }} MB
+        volumes size:{{ "%7.1f" | format(bytes_out / 1000000) }} MB ({{ compression }}, ratio {{ "%.2f" | format(ratio) }})
+       target filled:{{ "%7.1f" | format(filled * 100) }} %
+          throughput:{{ "%7.1f" | format(throughput / 1000000) }} MB/s
+           throttled:{{ "%7.1f" | format(throttled) }} s{% if lowest_rate %}, down to {{ "%.1f" | format(lowest_rate / 1000000) }} MB/s{% endif %}
+
+  Volumes:
+  {% for volume in volumes %}  {{ volume.name }}:{{ "%7.1f" | format(volume.size / 1000000) }} MB{% if not volume.complete %}, incomplete{% endif %}
+  {% endfor %}
+
+  Reclaimable:
+  {% for volume in reclaimable %}  {{ volume.tarfile }}:{{ "%7.1f" | format(volume.reclaimable / 1000000) }} MB of {{ "%.1f" | format(volume.size / 1000000) }} MB, {{ "%.0f" | format(volume.live * 100) }} % live
+  {% endfor %}
+
+  Phases:
+  {% for phase in phases %}{{ "%18s" | format(phase.name) }}:{{ "%7.1f" | format(phase.wall) }} s, cpu {{ "%.1f" | format(phase.cpu) }} s, {{ phase.count }} {{ phase.unit }}, {{ "%.0f" | format(phase.rate) }}/s
+  {% endfor %}{{ "%18s" | format('run') }}:{{ "%7.1f" | format(run_seconds) }} s, cpu {{ "%.1f" | format(run_cpu) }} s
+
+  Stages:
+  {% for stage in stages %}{{ "%18s" | format(stage.name) }}:{{ "%7.1f" | format(stage.seconds) }} s, {% if stage.cpu is not none %}cpu {{ "%.1f" | format(stage.cpu) }} s, {% endif %}{{ "%.1f" | format(stage.bytes_in / 1000000) }} MB in, {{ "%.1f" | format(stage.bytes_out / 1000000) }} MB out, exit {{ stage.exit }}
+  {% endfor %}
 
   Errors:
   {% for error in errors %}
@@ -79,189 +199,2402 @@ resultT: |
 """configuration as a nested dictionary"""
 error_list: list[str] = []
 vol_num = 0
-"""current volume number"""
-tar_proc: subprocess.Popen
-"""tar subprocess"""
-enc_proc: subprocess.Popen
-"""gpg encryption process"""
-xz_proc: subprocess.Popen
-"""xz subprocess"""
+"""number of the next volume"""
+vol_lock = threading.Lock()
+first_vol = 0
+"""first volume of this run, the cyclic backup takes files from older ones"""
+volumes: list['Volume'] = []
+"""volumes written by this run"""
+open_volumes: list['Volume'] = []
+"""volumes taking files"""
+deferred: list[tuple[str, os.stat_result, 'bytes | None']] = []
+"""files not fitting into the open volumes, offered to the next one, with their content hash"""
+MAX_DEFERRED = 1000
+"""deferred files starting the next volume early"""
 msg_list: list[str] = []
-target_file: BinaryIO
-blacklist = {}
-excluding = []
+blacklist: 'PathTrie'
+"""directories flagged for exclusion"""
+excluding: 'PathMatcher'
+"""compiled exclude patterns"""
 start_device = 0
 max_age = 0
-tarring = set()
 set_lock = threading.Lock()
+"""guards the names fed to tar and the counts updated by the archivers"""
+reader_pool: ThreadPoolExecutor
+"""threads reading the error output of the stages"""
+hasher: 'Hasher | None' = None
+"""hashes changed files if hashing is on"""
+run_digests: dict[bytes, int] = {}
+"""content hashes admitted by this run with their volume"""
+chunk_above = 0
+"""files of at least this size are archived in chunks, 0 for none"""
+sparse_files = False
+"""holes of sparse files are left out"""
+readahead: 'ThreadPoolExecutor | None' = None
+"""thread prefetching the files of a read window"""
+run_inodes: dict[tuple[int, int], tuple['Volume', str]] = {}
+"""volume and name each file with several links went into in this run, by device and inode"""
+run_names: set['str | tuple[str, int]'] = set()
+"""files and (file, chunk index) admitted by this run; the catalog shows their old volume until the volume
+holding them is promoted, so the cyclic backup skips them"""
+low_impact = False
+"""files read and volumes written are dropped from the page cache"""
+frame_size = 0
+"""archive bytes per frame of a volume, 0 for volumes of one stream"""
+walk_started = 0.0
+"""start of the full walk of this run once it completed"""
+journal_done: list[tuple[str, float]] = []
+"""journal entries this run backed up, with the time they were noted"""
+unsettled: set[str] = set()
+"""directories with files left for a later run"""
+throttle: 'Throttle | None' = None
+"""keeps the archivers to the I/O rate, if limited"""
+
+
+def parse_size(size, default: int) -> int:
+    """
+    converts a size like 500m or 2G into bytes
+    """
+    size_pat = re.compile('(\\d+)([kKmMgG]?)')
+    m = size_pat.search(str(size))
+    if m is None:
+        return default
+    s = int(m.group(1))
+    u = m.group(2)
+    if u == 'k':
+        s *= 1000
+    elif u == 'K':
+        s *= 1024
+    elif u == 'm':
+        s *= 1000000
+    elif u == 'M':
+        s *= 1024 * 1024
+    elif u == 'g':
+        s *= 1000 * 1000 * 1000
+    elif u == 'G':
+        s *= 1024 * 1024 * 1024
+    return s
+
+
+TAIL_SZ = 64 * 1024
+"""end of the archive, trailers of compression and encryption"""
+MAX_EXPANSION = 1.01
+"""output per input byte of the compression and encryption for incompressible data"""
+STALL_TIME = 10
+"""seconds without progress of the pipeline after which pending names are taken as failed"""
+MAX_LAG_SHARE = 0.25
+"""part of max_target_size the data held back by the compression may take, larger blocks or more threads are cut"""
+PIPE_HOLD = 256 * 1024
+"""bytes the pipes and gpg may hold beyond what the compression is known to have done"""
+PHASES = {'walk': 'entries listed', 'incremental': 'entries checked', 'volume_wait': 'waits',
+          'cyclic': 'files planned', 'catalog': 'rows written'}
+"""phases of the run timed on their own, with what they count"""
+
+
+def header_size(name: str) -> int:
+    """
+    bytes of the header of a member, extra headers for long names included
+    """
+    blocks = 1
+    name_len = len(os.fsencode(name))
+    if name_len >= 100:
+        blocks += 1 + -(-(name_len + 32) // HEADER_SZ)
+    return blocks * HEADER_SZ
+
+
+def member_size(name: str, stat_buf: os.stat_result) -> int:
+    """
+    bytes a file takes in the archive: header, data padded to full blocks; only the data extents of sparse files
+    """
+    size = header_size(name)
+    if is_sparse(stat_buf):
+        extents = file_extents(name, stat_buf.st_size)
+        if extents is not None:
+            return size + sparse_data_size(extents)
+    if stat.S_ISREG(stat_buf.st_mode) or stat.S_ISLNK(stat_buf.st_mode):
+        size += -(-stat_buf.st_size // HEADER_SZ) * HEADER_SZ
+    return size
+
+
+def is_sparse(stat_buf: os.stat_result) -> bool:
+    """
+    the file may have holes, as it has fewer blocks allocated than its size
+    """
+    return sparse_files and stat.S_ISREG(stat_buf.st_mode) and stat_buf.st_blocks * 512 < stat_buf.st_size
+
+
+def data_extents(fd: int, size: int, start: int = 0) -> list[tuple[int, int]]:
+    """
+    (offset, length) of the data of a file from start up to size, found with SEEK_DATA and SEEK_HOLE;
+    one extent for all if the file system does not tell the holes
+    """
+    extents = []
+    offset = start
+    try:
+        while offset < size:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+            if data >= size:
+                break
+            offset = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+            extents.append((data, offset - data))
+    except OSError as ex:
+        # ENXIO: no data after offset
+        if ex.errno != errno.ENXIO:
+            return [(start, size - start)]
+    os.lseek(fd, 0, os.SEEK_SET)
+    return extents
+
+
+def file_extents(name: str, size: int) -> 'list[tuple[int, int]] | None':
+    """
+    data extents of a file with holes, None if it has none or cannot be read
+    """
+    try:
+        fd = os.open(name, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        extents = data_extents(fd, size)
+    finally:
+        os.close(fd)
+    return None if extents == [(0, size)] else extents
+
+
+def sparse_map(extents: list[tuple[int, int]], size: int) -> bytes:
+    """
+    the map heading the data of a sparse member in GNU format 1.0, padded to full blocks;
+    a hole at the end gets an empty extent, so the map tells the size
+    """
+    if len(extents) == 0 or sum(extents[-1]) < size:
+        extents = extents + [(size, 0)]
+    text = f'{len(extents)}\n' + ''.join(f'{offset}\n{length}\n' for offset, length in extents)
+    return text.encode().ljust(-(-len(text) // HEADER_SZ) * HEADER_SZ, b'\0')
+
+
+def sparse_member(info: tarfile.TarInfo, extents: list[tuple[int, int]], start: int) -> bytes:
+    """
+    turns the member of the file from start on into one in GNU sparse format 1.0, as tar --sparse --format=pax
+    writes it, returns the map heading its data
+    """
+    header = sparse_map([(offset - start, length) for offset, length in extents], info.size)
+    # the long name tar would put into path comes first, so the real name read after it wins
+    info.pax_headers = {'path': os.path.join(os.path.dirname(info.name), 'GNUSparseFile.0',
+                                             os.path.basename(info.name)),
+                        **info.pax_headers, 'GNU.sparse.major': '1', 'GNU.sparse.minor': '0',
+                        'GNU.sparse.name': info.name, 'GNU.sparse.realsize': str(info.size)}
+    info.name = info.pax_headers['path']
+    info.size = len(header) + sum(length for _, length in extents)
+    return header
+
+
+def sparse_data_size(extents: list[tuple[int, int]]) -> int:
+    """
+    bytes the data of a sparse member takes, whichever format tar picks: pax headers, the map
+    or the extension headers of the old GNU format, the data extents padded to full blocks
+    """
+    data = sum(length for _, length in extents)
+    entries = len(extents) + 1
+    map_size = max(-(-entries * 2 * 21 // HEADER_SZ), -(-entries // 21)) * HEADER_SZ
+    return 2 * HEADER_SZ + map_size + -(-data // HEADER_SZ) * HEADER_SZ
+
+
+CHUNK_SUFFIX = '.pybackup-chunk.'
+"""member name of a chunk: the name of the file, this and the index of the chunk"""
+CHUNK_OFFSET = 'PYBACKUP.offset'
+"""pax header with the offset of a chunk in its file"""
+
+
+def chunk_name(name: str, idx: int) -> str:
+    return f'{name}{CHUNK_SUFFIX}{idx:06d}'
+
+
+def chunk_extents(extents: 'list[tuple[int, int]] | None', offset: int, length: int) \
+        -> 'list[tuple[int, int]] | None':
+    """
+    the data extents of a file with holes within a chunk, None if the chunk has no holes
+    """
+    if extents is None:
+        return None
+    end = offset + length
+    inside = [(max(start, offset), min(start + size, end) - max(start, offset)) for start, size in extents
+              if start < end and start + size > offset]
+    return None if inside == [(offset, length)] else inside
+
+
+def chunk_member_size(name: str, length: int, extents: 'list[tuple[int, int]] | None' = None) -> int:
+    """
+    bytes a chunk takes in the archive: pax header with its records, header, data padded to full blocks;
+    only the data extents of a chunk with holes
+    """
+    if extents is not None:
+        return header_size(chunk_name(name, 0)) + sparse_data_size(extents)
+    return 2 * HEADER_SZ + header_size(chunk_name(name, 0)) + -(-length // HEADER_SZ) * HEADER_SZ
+
+
+class Phase:
+    """
+    wall and CPU time of a phase of the run, summed over the stretches and threads it ran in,
+    with the items it handled; CPU time is that of the threads, not of the subprocesses
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.items = 0
+        self.lock = threading.Lock()
+
+    def add(self, wall: float = 0.0, cpu: float = 0.0, items: int = 0):
+        with self.lock:
+            self.wall += wall
+            self.cpu += cpu
+            self.items += items
+
+    def report(self) -> dict:
+        return {'name': self.name, 'wall': self.wall, 'cpu': self.cpu, 'count': self.items, 'unit': PHASES[self.name],
+                'rate': self.items / self.wall if self.wall > 0 else 0.0}
+
+
+phases = {name: Phase(name) for name in PHASES}
+"""time spent in each phase of the run"""
+
+
+@contextlib.contextmanager
+def timed(name: str):
+    """
+    adds the wall and CPU time of the block to a phase, the block counts its items on the phase it gets
+    """
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield phases[name]
+    finally:
+        phases[name].add(time.perf_counter() - wall, time.thread_time() - cpu)
+
+
+class SizeCheck:
+    """
+    keeps a volume below the target size, measuring the compressed output instead of the input;
+    a file is admitted if the output so far plus everything not yet written stays below the target
+    even if nothing of that compresses, so the target is never exceeded;
+    if the estimated ratio says it would fit, the scan waits for the pipeline to drain first
+    """
+
+    def __init__(self, size: str, fd: int, lag: int = 0):
+        self.fd = fd
+        self.target = parse_size(size, 500 * 1024 * 1024) - TAIL_SZ
+        self.lag = lag
+        """bytes the pipeline may hold before they show up in the target"""
+        self.drained = None
+        """archive bytes whose output surely reached the compression output, None if that is not measured"""
+        self.reserved = 0
+        """archive bytes of the admitted files"""
+        self.fed = 0
+        """archive bytes of the files the archiver is done with"""
+        self.waiting = 0
+        """admitted files the archiver did not report yet"""
+        self.held_back = 0
+        """files the archiver reports only once it gets the next one, tar reports a file when it starts the next"""
+        self.cond = threading.Condition()
+        logging.debug(f"aiming at archive not exceeding {self.target} bytes, {lag} bytes in flight")
+
+    def written(self) -> int:
+        return os.fstat(self.fd).st_size
+
+    def ratio(self) -> float:
+        """
+        compressed bytes per archive byte so far, 1.0 until there is output
+        """
+        written = self.written()
+        if written == 0 or self.fed == 0:
+            return 1.0
+        return min(written / self.fed, MAX_EXPANSION)
+
+    def fits(self, size: int) -> bool:
+        # what went into the pipeline and is not yet in the target is at most lag bytes
+        pending = self.reserved - self.fed + size + min(self.lag, self.fed)
+        if self.written() + pending * MAX_EXPANSION <= self.target:
+            return True
+        if self.drained is None:
+            return False
+        # the backlog measured at the compression is less than the worst case lag near the end of a volume
+        drained = self.drained()
+        if drained is None:
+            return False
+        held = min(self.lag, max(self.fed - drained, 0) + PIPE_HOLD)
+        return self.written() + (self.reserved - self.fed + size + held) * MAX_EXPANSION <= self.target
+
+    def pending(self) -> int:
+        return self.reserved - self.fed
+
+    def reserve(self, size: int, wait: bool = True) -> bool:
+        """
+        admits size bytes of the archive if they fit, waiting for the pipeline to drain if wait
+        """
+        with self.cond:
+            while not self.fits(size):
+                if self.waiting <= self.held_back or not wait:
+                    # nothing is reported before more files come
+                    return False
+                written = self.written()
+                if written > 0 and written + (self.reserved - self.fed + size) * self.ratio() > self.target:
+                    # it will not fit even after the pipeline drained
+                    return False
+                fed = self.fed
+                with timed('volume_wait') as phase:
+                    phase.add(items=1)
+                    progressed = self.cond.wait_for(lambda: self.fed != fed, STALL_TIME)
+                if not progressed:
+                    if throttle is not None and throttle.holding():
+                        continue
+                    logging.warning(f'no progress in {STALL_TIME}s, taking {self.waiting} pending names as failed')
+                    self.waiting = 0
+            self.reserved += size
+            self.waiting += 1
+            return True
+
+    def room(self) -> int:
+        """
+        archive bytes that may still fit at the ratio seen so far
+        """
+        with self.cond:
+            return int((self.target - self.written()) / self.ratio()) - self.pending()
+
+    def acknowledged(self, size: int):
+        """
+        the archiver is done with a file, size bytes of the archive went into the pipeline
+        """
+        with self.cond:
+            self.fed += size
+            self.waiting = max(self.waiting - 1, 0)
+            self.cond.notify_all()
+
+    def is_filled(self) -> bool:
+        with self.cond:
+            return self.waiting <= self.held_back and not self.fits(HEADER_SZ)
+
+
+
+class PathMatcher:
+    """
+    tests paths against all exclude patterns with one regular expression;
+    plain text patterns (optionally anchored with ^ or $) are merged into a trie of alternatives, so the engine
+    only follows the patterns sharing the text read so far; the cost still grows with the patterns, as the
+    alternatives of a trie node are tried one by one at each position of the path (pybench.py matcher: about
+    0.3 us per path for one pattern, 9 us for 10000, where testing them one by one takes 1.5 ms);
+    other patterns are appended as alternatives; patterns with back references, named groups or global inline
+    flags cannot share one expression and are kept apart
+    """
+
+    def __init__(self, patterns: list[str]):
+        self.patterns = []
+        words = {'': [], '^': [], '$': []}
+        merged = []
+        for pattern in patterns:
+            literal = self.literal(pattern)
+            if literal is not None:
+                words[literal[0]].append(literal[1])
+            elif re.search('\\\\[1-9]|\\(\\?P[=<]|\\(\\?[aiLmsux]+\\)', pattern):
+                self.patterns.append(re.compile(pattern))
+            else:
+                merged.append(f'(?:{pattern})')
+        if len(words['']) > 0:
+            merged.insert(0, self.trie_regex(words[''], False))
+        if len(words['^']) > 0:
+            merged.insert(0, '^' + self.trie_regex(words['^'], False))
+        if len(words['$']) > 0:
+            merged.insert(0, self.trie_regex(words['$'], True) + '$')
+        if len(merged) > 0:
+            try:
+                self.patterns.insert(0, re.compile('|'.join(merged)))
+            except re.error as ex:
+                # some construct that only works on its own, matched one by one as before
+                logging.debug(f'exclude patterns not merged: {ex}')
+                self.patterns[:0] = [re.compile(pattern) for pattern in merged]
+
+    @staticmethod
+    def literal(pattern: str):
+        """
+        returns (anchor, text) for a pattern without regular expression syntax, None otherwise
+        """
+        anchor = ''
+        if pattern.startswith('^'):
+            anchor = '^'
+            pattern = pattern[1:]
+        elif pattern.endswith('$') and not pattern.endswith('\\$'):
+            anchor = '$'
+            pattern = pattern[:-1]
+        text = []
+        escaped = False
+        for ch in pattern:
+            if escaped:
+                # \d, \w and friends are classes, not characters
+                if ch.isalnum():
+                    return None
+                text.append(ch)
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch in '.^$*+?{}[]|()':
+                return None
+            else:
+                text.append(ch)
+        if escaped or len(text) == 0:
+            return None
+        return anchor, ''.join(text)
+
+    @staticmethod
+    def trie_regex(words: list[str], at_end: bool) -> str:
+        """
+        builds a regular expression matching any of the words with common prefixes factored out;
+        unless the match has to reach the end, a word makes its longer continuations superfluous
+        """
+        trie = {}
+        for word in words:
+            node = trie
+            for ch in word:
+                node = node.setdefault(ch, {})
+            node[''] = {}
+
+        def build(node: dict) -> str:
+            if '' in node and not at_end:
+                return ''
+            alternatives = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch != '']
+            if len(alternatives) == 0:
+                return ''
+            if len(alternatives) == 1 and '' not in node:
+                return alternatives[0]
+            rx = '(?:' + '|'.join(alternatives) + ')'
+            if '' in node:
+                rx += '?'
+            return rx
+
+        return '(?:' + build(trie) + ')'
+
+    def search(self, path: str) -> bool:
+        for pattern in self.patterns:
+            if pattern.search(path) is not None:
+                return True
+        return False
+
+
+class PathTrie:
+    """
+    set of directories stored by path components,
+    tells in O(depth) whether a path is one of them or lies below one
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, path: str):
+        node = self.root
+        for part in path.rstrip(os.path.sep).split(os.path.sep):
+            node = node.setdefault(part, {})
+        node[None] = True
+
+    def covers(self, path: str) -> bool:
+        node = self.root
+        for part in path.rstrip(os.path.sep).split(os.path.sep):
+            if None in node:
+                return True
+            node = node.get(part)
+            if node is None:
+                return False
+        return None in node
+
+
+class CatalogWriter:
+    """
+    writes catalog updates in batches from its own thread and connection;
+    archived files are staged in a temporary table and only promoted into files
+    once the volume holding them has been written completely
+    """
+    statements = {
+        'archived': 'insert into pending(dir,base,mtime,volume,size,hash,dev,ino,pos,length) '
+                    'values(?,?,?,?,?,?,?,?,?,?)',
+        'chunk': 'insert into pending_chunks(dir,base,idx,volume,size,hash,pos,length) values(?,?,?,?,?,?,?,?)',
+        'removed': 'delete from files where dir_id=(select id from dirs where path=?) and base=?',
+        'flagged': 'replace into flagged(name) values(?)',
+        'unflagged': 'delete from flagged where name=?',
+        'dirs': 'insert or ignore into dirs(path) values(?)',
+        'duplicate': 'replace into files(dir_id,base,mtime,volume,size,hash,src,dev,ino) '
+                     'values((select id from dirs where path=?),?,?,NULL,?,?,?,?,?)',
+        'chunked': 'replace into files(dir_id,base,mtime,volume,size) '
+                   'values((select id from dirs where path=?),?,?,NULL,?)',
+        'touched': 'update files set mtime=? where dir_id=(select id from dirs where path=?) and base=?',
+        'truncated': 'delete from chunks where dir_id=(select id from dirs where path=?) and base=? and idx>=?',
+    }
+    """statement for each kind of update"""
+
+    def __init__(self, db_file: str):
+        self.queue = queue.Queue()
+        self.conn = open_database(db_file)
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS pending '
+                          '(dir TEXT NOT NULL, base TEXT NOT NULL, mtime REAL NOT NULL, volume INTEGER, size INTEGER, '
+                          'hash BLOB, dev INTEGER, ino INTEGER, pos INTEGER, length INTEGER)')
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS pending_chunks '
+                          '(dir TEXT NOT NULL, base TEXT NOT NULL, idx INTEGER NOT NULL, volume INTEGER NOT NULL, '
+                          'size INTEGER NOT NULL, hash BLOB, pos INTEGER, length INTEGER)')
+        self.batch = int(config['db_batch'])
+        self.interval = float(config['db_interval'])
+        self.thread = threading.Thread(target=self.run, name='catalog')
+        self.thread.start()
+
+    def archived(self, name: str, mtime: int, volume: int, size: int, digest: 'bytes | None' = None,
+                 inode: 'tuple[int, int] | None' = None, member: 'tuple[int, int] | None' = None):
+        """
+        records a file archived in volume; member is where it lies in the archive of a framed volume
+        """
+        self.queue.put(('archived', (*os.path.split(name), mtime, volume, size, digest, *(inode or (None, None)),
+                                     *(member or (None, None)))))
+
+    def duplicate(self, name: str, mtime: int, size: int, digest: 'bytes | None', src: int,
+                  inode: 'tuple[int, int] | None' = None):
+        """
+        records a file whose content is archived in volume src under another name,
+        found by its hash or as a hard link by its device and inode
+        """
+        path, base = os.path.split(name)
+        self.queue.put(('dirs', (path,)))
+        self.queue.put(('duplicate', (path, base, mtime, size, digest, src, *(inode or (None, None)))))
+        self.queue.put(('truncated', (path, base, 0)))
+
+    def touched(self, name: str, mtime: int):
+        """
+        takes the new mtime of a file whose content did not change
+        """
+        self.queue.put(('touched', (mtime, *os.path.split(name))))
+
+    def chunk_archived(self, name: str, idx: int, volume: int, size: int, digest: bytes,
+                       member: 'tuple[int, int] | None' = None):
+        self.queue.put(('chunk', (*os.path.split(name), idx, volume, size, digest, *(member or (None, None)))))
+
+    def chunked(self, name: str, mtime: int, size: int, chunks: int):
+        """
+        records a file archived in chunks, once all volumes holding its chunks are promoted
+        """
+        path, base = os.path.split(name)
+        self.queue.put(('dirs', (path,)))
+        self.queue.put(('chunked', (path, base, mtime, size)))
+        self.queue.put(('truncated', (path, base, chunks)))
+
+    def removed(self, name: str):
+        self.queue.put(('removed', os.path.split(name)))
+        self.queue.put(('truncated', (*os.path.split(name), 0)))
+
+    def flagged(self, name: str, present: bool):
+        """
+        records or forgets a directory holding the exclude flag
+        """
+        self.queue.put(('flagged' if present else 'unflagged', (name,)))
+
+    def promote(self, volume: int, success: bool):
+        """
+        moves the staged files of a volume into the catalog, or drops them if the volume failed;
+        returns after the writer thread has done so
+        """
+        done = threading.Event()
+        self.queue.put(('promote', (volume, success, done)))
+        done.wait()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.conn.close()
+
+    def flush(self, batches: dict[str, list]):
+        """
+        writes the queued rows in one transaction, keeps them for the next attempt if that fails
+        """
+        if sum(len(rows) for rows in batches.values()) == 0:
+            return
+        with timed('catalog') as phase, self.conn:
+            for kind, rows in batches.items():
+                self.conn.executemany(self.statements[kind], rows)
+                phase.add(items=len(rows))
+        logging.debug('catalog: ' + ', '.join(f'{kind} {len(rows)}' for kind, rows in batches.items()))
+        for rows in batches.values():
+            rows.clear()
+
+    def run(self):
+        batches = {kind: [] for kind in self.statements}
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, last_flush + self.interval - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ('timeout', None)
+            if item is None:
+                self.flush(batches)
+                return
+            kind, args = item
+            if kind in batches:
+                batches[kind].append(args)
+            elif kind == 'promote':
+                volume, success, done = args
+                try:
+                    self.flush(batches)
+                    with timed('catalog'), self.conn:
+                        if success:
+                            self.conn.execute('insert or ignore into dirs(path) '
+                                              'select distinct dir from pending where volume=?', (volume,))
+                            self.conn.execute('replace into files(dir_id,base,mtime,volume,size,hash,dev,ino,pos,length) '
+                                              'select d.id,p.base,p.mtime,p.volume,p.size,p.hash,p.dev,p.ino,'
+                                              'p.pos,p.length '
+                                              'from pending as p '
+                                              'join dirs as d on d.path=p.dir where p.volume=?', (volume,))
+                            # files archived whole have no chunks any more
+                            self.conn.execute('delete from chunks where (dir_id,base) in (select d.id,p.base '
+                                              'from pending as p join dirs as d on d.path=p.dir where p.volume=?)',
+                                              (volume,))
+                            self.conn.execute('insert or ignore into dirs(path) '
+                                              'select distinct dir from pending_chunks where volume=?', (volume,))
+                            self.conn.execute('replace into chunks(dir_id,base,idx,volume,size,hash,pos,length) '
+                                              'select d.id,p.base,p.idx,p.volume,p.size,p.hash,p.pos,p.length '
+                                              'from pending_chunks as p '
+                                              'join dirs as d on d.path=p.dir where p.volume=?', (volume,))
+                        self.conn.execute('delete from pending where volume=?', (volume,))
+                        self.conn.execute('delete from pending_chunks where volume=?', (volume,))
+                    logging.debug(f"catalog: volume {volume} {'promoted' if success else 'dropped'}")
+                except sqlite3.Error as ex:
+                    logging.error(f'catalog: promoting volume {volume} failed: {ex}')
+                    error_list.append(f'catalog update for volume {volume} failed: {ex}')
+                finally:
+                    done.set()
+            if sum(len(rows) for rows in batches.values()) >= self.batch \
+                    or time.monotonic() - last_flush >= self.interval:
+                try:
+                    self.flush(batches)
+                except sqlite3.Error as ex:
+                    logging.error(f'catalog: flushing failed, retrying later: {ex}')
+                last_flush = time.monotonic()
+
+
+catalog: CatalogWriter
+
+
+class CatalogIndex:
+    """
+    answers which mtime and volume the catalog holds for a path;
+    either from an open addressing hash table loaded once into arrays,
+    with one query per directory when the table would exceed db_preload_memory,
+    or with one query per path when preloading is off
+    """
+    SLOT_SZ = 20
+    """bytes per slot: hash, mtime and volume"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.cache = {}
+        self.mode = 'query'
+        self.dir = (None, None)
+        """path and id of the directory looked up last"""
+        if not config['db_preload']:
+            return
+        row = conn.execute('select count(*) from files').fetchone()
+        slots = 1024
+        while slots * 0.6 < row[0]:
+            slots *= 2
+        limit = parse_size(config['db_preload_memory'], 256 * 1024 * 1024)
+        if slots * self.SLOT_SZ > limit:
+            logging.info(f"catalog of {row[0]} rows exceeds {limit} bytes, using chunked lookups")
+            self.mode = 'chunked'
+            return
+        self.mode = 'memory'
+        self.mask = slots - 1
+        self.keys = array.array('q', bytes(8 * slots))
+        self.mtimes = array.array('q', bytes(8 * slots))
+        self.volumes = array.array('i', bytes(4 * slots))
+        dirs = dict(conn.execute('select id, path from dirs'))
+        for dir_id, base, mtime, volume in conn.execute('select dir_id, base, mtime, volume from files'):
+            name = os.path.join(dirs[dir_id], base)
+            slot = self.find(name)
+            self.keys[slot] = self.key(name)
+            self.mtimes[slot] = int(mtime)
+            self.volumes[slot] = volume if volume is not None else -1
+        logging.info(f"preloaded {row[0]} catalog rows into {slots} slots")
+
+    @staticmethod
+    def key(name: str) -> int:
+        # 0 marks an empty slot
+        return hash(name) or 1
+
+    def find(self, name: str) -> int:
+        """
+        returns the slot holding name or the empty slot where it belongs
+        """
+        key = self.key(name)
+        slot = key & self.mask
+        while True:
+            k = self.keys[slot]
+            if k == key or k == 0:
+                return slot
+            slot = (slot + 1) & self.mask
+
+    def prefetch(self, names: list[str]):
+        """
+        loads the rows for the entries of one directory in chunked mode
+        """
+        if self.mode != 'chunked':
+            return
+        self.cache.clear()
+        for path in set(os.path.dirname(name) for name in names):
+            for base, mtime, volume in self.conn.execute(
+                    'select base, mtime, volume from files where dir_id=(select id from dirs where path=?)', (path,)):
+                self.cache[os.path.join(path, base)] = (int(mtime), volume)
+
+    def lookup(self, name: str):
+        """
+        returns (mtime, volume) from the catalog or None for unknown files
+        """
+        if self.mode == 'memory':
+            slot = self.find(name)
+            if self.keys[slot] == 0:
+                return None
+            volume = self.volumes[slot]
+            return self.mtimes[slot], volume if volume >= 0 else None
+        if self.mode == 'chunked':
+            return self.cache.get(name)
+        path, base = os.path.split(name)
+        if self.dir[0] != path:
+            row = self.conn.execute('select id from dirs where path=?', (path,)).fetchone()
+            self.dir = (path, row[0] if row is not None else None)
+        row = self.conn.execute('select mtime, volume from files where dir_id=? and base=?',
+                                (self.dir[1], base)).fetchone()
+        if row is None:
+            return None
+        return int(row[0]), row[1]
+
+
+catalog_index: CatalogIndex
+
+
+def open_database(db_file: str) -> sqlite3.Connection:
+    """
+    opens a connection to the catalog with the configured journal mode and synchronous level
+    """
+    conn = sqlite3.connect(db_file, check_same_thread=False)
+    conn.execute(f"pragma journal_mode={config['db_journal']}")
+    conn.execute(f"pragma synchronous={config['db_synchronous']}")
+    return conn
+
+
+def normalize_paths(conn: sqlite3.Connection):
+    """
+    splits the names of the files into a table of directories and the base names, keyed by the directory id;
+    the directory is everything up to the last '/', like os.path.split
+    """
+    conn.execute('BEGIN')
+    conn.execute('CREATE TABLE dirs (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE)')
+    conn.execute('CREATE TEMP TABLE split AS SELECT name, rtrim(name, replace(name, \'/\', \'\')) AS prefix, '
+                 'mtime, volume, size FROM files')
+    conn.execute("INSERT INTO dirs(path) SELECT DISTINCT CASE WHEN prefix = '/' THEN prefix "
+                 "ELSE substr(prefix, 1, length(prefix) - 1) END AS dir FROM split ORDER BY dir")
+    conn.execute('CREATE TABLE files_v5 (dir_id INTEGER NOT NULL, base TEXT NOT NULL, mtime REAL NOT NULL, '
+                 'volume INTEGER, size INTEGER)')
+    conn.execute("INSERT INTO files_v5 SELECT d.id, substr(s.name, length(s.prefix) + 1), s.mtime, s.volume, s.size "
+                 "FROM split AS s JOIN dirs AS d ON d.path = CASE WHEN s.prefix = '/' THEN s.prefix "
+                 "ELSE substr(s.prefix, 1, length(s.prefix) - 1) END ORDER BY d.id")
+    conn.execute('DROP TABLE split')
+    conn.execute('DROP TABLE files')
+    conn.execute('ALTER TABLE files_v5 RENAME TO files')
+    conn.execute('CREATE UNIQUE INDEX entry on files (dir_id ASC, base ASC)')
+    conn.execute('CREATE INDEX vol_size on files (volume ASC, size ASC)')
+
+
+schema_upgrades: dict[int, list] = {
+    2: [
+        'CREATE TABLE flagged (name TEXT NOT NULL PRIMARY KEY)',
+    ],
+    3: [
+        'ALTER TABLE files ADD COLUMN size INTEGER',
+        'CREATE INDEX vol_size on files (volume ASC, size ASC)',
+        # vol_size serves everything vols did
+        'DROP INDEX vols',
+    ],
+    4: [
+        # bytes of the files when the volume was written, size of the volume file
+        'ALTER TABLE backup ADD COLUMN bytes INTEGER',
+        'ALTER TABLE backup ADD COLUMN size INTEGER',
+    ],
+    5: [
+        normalize_paths,
+    ],
+    6: [
+        # content hash of the file; a duplicate has no volume, src is the volume holding its content
+        'ALTER TABLE files ADD COLUMN hash BLOB',
+        'ALTER TABLE files ADD COLUMN src INTEGER',
+        'CREATE INDEX content on files (hash) WHERE hash IS NOT NULL',
+        'CREATE INDEX dup_src on files (src) WHERE src IS NOT NULL',
+    ],
+    7: [
+        # chunks of large files, the file itself has no volume
+        'CREATE TABLE chunks (dir_id INTEGER NOT NULL, base TEXT NOT NULL, idx INTEGER NOT NULL, '
+        'volume INTEGER NOT NULL, size INTEGER NOT NULL, hash BLOB)',
+        'CREATE UNIQUE INDEX chunk_entry on chunks (dir_id ASC, base ASC, idx ASC)',
+        'CREATE INDEX chunk_vol on chunks (volume ASC)',
+    ],
+    8: [
+        # device and inode of files with several links
+        'ALTER TABLE files ADD COLUMN dev INTEGER',
+        'ALTER TABLE files ADD COLUMN ino INTEGER',
+        'CREATE INDEX inode on files (ino, dev) WHERE ino IS NOT NULL',
+    ],
+    9: [
+        # where files and chunks lie in the archive of a framed volume, and where its frames are
+        'ALTER TABLE files ADD COLUMN pos INTEGER',
+        'ALTER TABLE files ADD COLUMN length INTEGER',
+        'ALTER TABLE chunks ADD COLUMN pos INTEGER',
+        'ALTER TABLE chunks ADD COLUMN length INTEGER',
+        'CREATE TABLE frames (volume INTEGER NOT NULL, pos INTEGER NOT NULL, length INTEGER NOT NULL, '
+        'start INTEGER NOT NULL, size INTEGER NOT NULL)',
+        'CREATE UNIQUE INDEX frame_pos on frames (volume ASC, pos ASC)',
+    ],
+    10: [
+        # when the volume was started, tells the files changed since
+        'ALTER TABLE backup ADD COLUMN started REAL',
+    ],
+    11: [
+        # directories pywatch.py saw changes in, deep for those created or moved in
+        'CREATE TABLE journal (path TEXT NOT NULL PRIMARY KEY, deep INTEGER NOT NULL, noted REAL NOT NULL)',
+        # the state of pywatch.py, and when the last complete full walk started
+        'CREATE TABLE watcher (id INTEGER PRIMARY KEY, roots TEXT NOT NULL, started REAL NOT NULL, '
+        'beat REAL NOT NULL, overflowed REAL NOT NULL, walked REAL)',
+    ],
+}
+"""statements or functions bringing the db from the previous version to this one"""
+
+
+def prep_database():
+    """
+    prepares the database
+    """
+    global db_conn, vol_num
+    version: int = 0
+    try:
+        row = db_conn.execute('select max(version) from dbv').fetchone()
+        if row is not None:
+            version = row[0]
+    except sqlite3.DatabaseError:
+        logging.info('db has no version')
+    if version == 0:
+        logging.info("creating db from scratch")
+        schema_stmts = [
+            'CREATE TABLE files (name TEXT NOT NULL, mtime REAL NOT NULL,volume INTEGER)',
+            'CREATE UNIQUE INDEX "prime" on files (name ASC)',
+            'CREATE INDEX vols on files (volume ASC)',
+            'CREATE TABLE backup (num INTEGER NOT NULL, tarfile TEXT NOT NULL)',
+            'CREATE INDEX bknum on backup (num ASC)',
+            'CREATE TABLE dbv(version INTEGER NOT NULL)',
+            'insert into dbv values(1)'
+        ]
+        for stmt in schema_stmts:
+            db_conn.execute(stmt)
+        db_conn.commit()
+        version = 1
+    upgraded = False
+    for new_version in sorted(schema_upgrades):
+        if new_version <= version:
+            continue
+        logging.info(f"upgrading db to version {new_version}")
+        for stmt in schema_upgrades[new_version]:
+            if callable(stmt):
+                stmt(db_conn)
+            else:
+                db_conn.execute(stmt)
+        db_conn.execute('insert into dbv values(?)', (new_version,))
+        db_conn.commit()
+        version = new_version
+        upgraded = True
+    if upgraded:
+        # hands the space of the replaced tables back
+        db_conn.execute('VACUUM')
+    row = db_conn.execute('select max(v) from (select max(volume) as v from files '
+                          'union all select max(volume) from chunks)').fetchone()
+    if row is not None and row[0] is not None:
+        vol_num = row[0] + 1
+
+
+def inode(stat_buf: os.stat_result) -> 'tuple[int, int] | None':
+    """
+    device and inode of a file with several links, None for others
+    """
+    if stat.S_ISREG(stat_buf.st_mode) and stat_buf.st_nlink > 1:
+        return stat_buf.st_dev, stat_buf.st_ino
+    return None
+
+
+def handle_tar_stderr(volume: 'Volume'):
+    global error_list, set_lock, counts
+    tar_proc = volume.stages[0].proc
+    # tar reports a member when starting it, so the one before is in the pipe
+    last_size = 0
+    last_name = None
+    while True:
+        line = tar_proc.stderr.readline()
+        if not line:
+            if low_impact and last_name is not None:
+                evict(last_name)
+            logging.debug("tar pipe closed")
+            return
+        line = line.strip()
+        if line.endswith('/'):
+            line = line[:-1]
+        if line.endswith('Exiting with failure status due to previous errors'):
+            volume.archiver.previous_errors = True
+        # outcomes:
+        # 1. - directory/ - no beginning "/", but ending "/"
+        # 2. - file  - no beginning "/", no ending "/"
+        # something else
+        with set_lock:
+            found = line in volume.tarring
+            if found:
+                volume.tarring.remove(line)
+        if found:
+            # adding the '/' at the beginning
+            line = os.path.sep + line
+            statbuf = os.lstat(line)
+            volume.size_check.acknowledged(last_size)
+            if low_impact and last_name is not None:
+                evict(last_name)
+            last_name = line if stat.S_ISREG(statbuf.st_mode) else None
+            last_size = volume.links.pop(line, None) or member_size(line, statbuf)
+            mtime = int(statbuf.st_mtime)
+            catalog.archived(line, mtime, volume.num, statbuf.st_size if stat.S_ISREG(statbuf.st_mode) else 0,
+                             volume.digests.pop(line, None), inode(statbuf))
+            with set_lock:
+                counts['backed_up'] += 1
+                if stat.S_ISREG(statbuf.st_mode):
+                    counts['bytes_in'] += statbuf.st_size
+        else:
+            print(f"tar stderr {line}")
+            error_list.append(line)
+
+
+def handle_stage_errors(stage: 'Stage'):
+    global error_list
+    for line in stage.proc.stderr:
+        line = line.decode(errors='replace').strip()
+        if len(line) == 0:
+            continue
+        print(f"{stage.name} stderr {line}")
+        error_list.append(f'{stage.name}: {line}')
+    logging.debug(f"{stage.name} pipe closed")
+
+
+class Stage:
+    """
+    a subprocess of the archive pipeline
+    """
+
+    def __init__(self, name: str, args: list[str], ok_codes=(0,), **popen_args):
+        self.name = name
+        self.args = args
+        self.ok_codes = ok_codes
+        """exit codes meaning a complete output"""
+        self.popen_args = popen_args
+        self.proc: subprocess.Popen = None
+        self.started = 0.0
+        self.ended = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu = 0.0
+
+    def start(self, stdin, stdout) -> subprocess.Popen:
+        logging.debug(f"starting {self.name}: {self.args[0]}")
+        self.started = time.monotonic()
+        self.proc = subprocess.Popen(self.args, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE,
+                                     **self.popen_args)
+        return self.proc
+
+    def wait(self) -> int:
+        try:
+            # an exited process keeps its counters until it is reaped
+            os.waitid(os.P_PID, self.proc.pid, os.WEXITED | os.WNOWAIT)
+            self.bytes_in, self.bytes_out, self.cpu = process_usage(self.proc.pid)
+        except (OSError, ValueError, KeyError):
+            pass
+        self.proc.wait()
+        self.ended = time.monotonic()
+        logging.debug(f"{self.name} finished with {self.proc.returncode} after {self.ended - self.started:.1f}s")
+        return self.proc.returncode
+
+    def succeeded(self) -> bool:
+        return self.proc.returncode in self.ok_codes
+
+    def report(self) -> dict:
+        return {'name': self.name, 'seconds': self.ended - self.started, 'exit': self.proc.returncode,
+                'cpu': self.cpu, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+
+class GnuTar:
+    """
+    feeds names to the tar subprocess, handle_tar_stderr learns from its verbose output what got archived
+    """
+
+    def __init__(self, volume: 'Volume'):
+        self.stage = volume.stages[0]
+        self.tarring = volume.tarring
+        self.previous_errors = False
+        """tar announced its exit status is due to errors on single files"""
+
+    def add(self, fullname: str, stat_buf: os.stat_result):
+        global set_lock
+        # removing the leading '/' so tar does not complain
+        name = fullname[1:]
+        with set_lock:
+            self.tarring.add(name.rstrip(os.path.sep))
+        print(name, file=self.stage.proc.stdin, flush=True)
+
+    def close(self):
+        self.stage.proc.stdin.close()
+
+    def completed(self) -> bool:
+        """
+        tar exits with 2 after files it could not read, which got no verbose line;
+        the archive is complete nevertheless
+        """
+        return self.stage.succeeded() or (self.stage.proc.returncode == 2 and self.previous_errors)
+
+    def report(self) -> dict:
+        return self.stage.report()
+
+
+class FixedSizeReader:
+    """
+    reads exactly size bytes from a file, padding with zeros if it shrank meanwhile;
+    feeds what it read to digest if given
+    """
+
+    def __init__(self, f: BinaryIO, size: int, digest=None):
+        self.f = f
+        self.left = size
+        self.short = False
+        self.digest = digest
+
+    def read(self, n: int) -> bytes:
+        n = min(n, self.left)
+        data = self.f.read(n)
+        while len(data) < n:
+            more = self.f.read(n - len(data))
+            if not more:
+                self.short = True
+                data += bytes(n - len(data))
+                break
+            data += more
+        self.left -= len(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        if throttle is not None:
+            throttle.wait(len(data))
+        return data
+
+
+class SparseReader:
+    """
+    reads the map of a sparse member followed by the data extents of the file;
+    feeds the file from start on to digest if given, the holes as zeros
+    """
+
+    def __init__(self, f: BinaryIO, header: bytes, extents: list[tuple[int, int]], digest=None, start: int = 0):
+        self.f = f
+        self.header = header
+        self.extents = collections.deque(extents)
+        self.reader: FixedSizeReader = None
+        self.short = False
+        self.digest = digest
+        self.pos = start
+
+    def hole(self, end: int):
+        """
+        hashes the zeros up to end, for a hole at the end once the member is written
+        """
+        if self.digest is not None and end > self.pos:
+            zeros = bytes(min(end - self.pos, 1024 * 1024))
+            while self.pos < end:
+                self.digest.update(zeros[:end - self.pos])
+                self.pos += min(len(zeros), end - self.pos)
+        self.pos = max(self.pos, end)
+
+    def read(self, n: int) -> bytes:
+        parts = []
+        while n > 0:
+            if len(self.header) > 0:
+                data, self.header = self.header[:n], self.header[n:]
+            elif self.reader is not None and self.reader.left > 0:
+                data = self.reader.read(n)
+                self.short = self.short or self.reader.short
+            elif len(self.extents) > 0:
+                offset, length = self.extents.popleft()
+                self.hole(offset)
+                self.f.seek(offset)
+                self.reader = FixedSizeReader(self.f, length, self.digest)
+                self.pos = offset + length
+                continue
+            else:
+                break
+            parts.append(data)
+            n -= len(data)
+        return b''.join(parts)
+
+
+class CountingWriter:
+    """
+    hands the archive to the next stage, counting the bytes written
+    """
+
+    def __init__(self, out: BinaryIO):
+        self.out = out
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        self.out.write(data)
+        self.written += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.written
+
+    def flush(self):
+        self.out.flush()
+
+
+class TarWriter:
+    """
+    writes the archive in process in pax format;
+    a member counts as archived once its bytes have been handed to the next stage
+    """
+
+    def __init__(self, volume: 'Volume'):
+        self.volume = volume
+        self.out = CountingWriter(volume.frames if volume.frames is not None else volume.stages[0].proc.stdin)
+        self.queue = queue.Queue(maxsize=1000)
+        self.failed = False
+        self.started = time.monotonic()
+        self.ended = 0.0
+        self.data = 0
+        """bytes of the files archived"""
+        self.cpu = 0.0
+        self.thread = threading.Thread(target=self.run, name=f'tarwriter-{volume.num}')
+        self.thread.start()
+
+    def add(self, fullname: str, stat_buf: os.stat_result):
+        self.queue.put(fullname)
+
+    def add_chunk(self, fullname: str, idx: int, offset: int, length: int):
+        self.queue.put((fullname, idx, offset, length))
+
+    def close(self):
+        """
+        finishes the archive and closes the pipe to the next stage
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.ended = time.monotonic()
+
+    def completed(self) -> bool:
+        return not self.failed
+
+    def report(self) -> dict:
+        return {'name': 'tarfile', 'seconds': self.ended - self.started, 'exit': 1 if self.failed else 0,
+                'cpu': self.cpu, 'bytes_in': self.data, 'bytes_out': self.out.written}
+
+    def write_member(self, tf: tarfile.TarFile, fullname: str) -> os.stat_result:
+        arcname = fullname.lstrip(os.path.sep)
+        stat_buf = os.lstat(fullname)
+        if not stat.S_ISREG(stat_buf.st_mode):
+            info = tf.gettarinfo(fullname, arcname)
+            if info is None:
+                raise ValueError(f'cannot archive the type of {fullname}')
+            tf.addfile(info)
+            return stat_buf
+        with open(fullname, 'rb') as f:
+            info = tf.gettarinfo(arcname=arcname, fileobj=f)
+            extents = data_extents(f.fileno(), info.size) if info.isreg() and is_sparse(stat_buf) else None
+            if extents is not None and extents != [(0, info.size)]:
+                reader = SparseReader(f, sparse_member(info, extents, 0), extents)
+                tf.addfile(info, reader)
+                if reader.short:
+                    error_list.append(f'{fullname}: shrank while being read, padded with zeros')
+            elif info.isreg():
+                reader = FixedSizeReader(f, info.size)
+                tf.addfile(info, reader)
+                if reader.short:
+                    error_list.append(f'{fullname}: shrank while being read, padded with zeros')
+            else:
+                # a hard link to a member already in the archive
+                tf.addfile(info)
+            if low_impact:
+                drop_cache(f.fileno())
+            return os.fstat(f.fileno())
+
+    def write_chunk(self, tf: tarfile.TarFile, fullname: str, idx: int, offset: int, length: int) -> bytes:
+        """
+        writes length bytes from offset of a file as a member of its own, returns the hash of what was written
+        """
+        with open(fullname, 'rb') as f:
+            stat_buf = os.fstat(f.fileno())
+            info = tarfile.TarInfo(chunk_name(fullname.lstrip(os.path.sep), idx))
+            info.size = length
+            info.mtime = stat_buf.st_mtime
+            info.mode = stat.S_IMODE(stat_buf.st_mode)
+            info.uid, info.gid = stat_buf.st_uid, stat_buf.st_gid
+            info.pax_headers = {CHUNK_OFFSET: str(offset)}
+            digest = hashlib.blake2b(digest_size=16)
+            extents = data_extents(f.fileno(), offset + length, offset) if is_sparse(stat_buf) else None
+            if extents is not None and extents != [(offset, length)]:
+                reader = SparseReader(f, sparse_member(info, extents, offset), extents, digest, offset)
+            else:
+                f.seek(offset)
+                reader = FixedSizeReader(f, length, digest)
+            tf.addfile(info, reader)
+            if isinstance(reader, SparseReader):
+                reader.hole(offset + length)
+            if reader.short:
+                error_list.append(f'{fullname}: shrank while being read, chunk {idx} padded with zeros')
+            if low_impact:
+                drop_cache(f.fileno(), offset, length)
+            return digest.digest()
+
+    def run(self):
+        global counts
+        try:
+            with tarfile.open(fileobj=self.out, mode='w', format=tarfile.PAX_FORMAT) as tf:
+                while True:
+                    item = self.queue.get()
+                    if item is None:
+                        break
+                    fullname = item[0] if isinstance(item, tuple) else item
+                    before = self.out.written
+                    try:
+                        if isinstance(item, tuple):
+                            digest = self.write_chunk(tf, *item)
+                        else:
+                            stat_buf = self.write_member(tf, fullname)
+                    except (FileNotFoundError, PermissionError, ValueError) as ex:
+                        logging.warning(f'not archived: {ex}')
+                        error_list.append(f'{fullname}: {ex}')
+                        self.volume.size_check.acknowledged(self.out.written - before)
+                        continue
+                    self.out.flush()
+                    self.volume.size_check.acknowledged(self.out.written - before)
+                    member = (before, self.out.written - before) if self.volume.frames is not None else None
+                    if isinstance(item, tuple):
+                        _, idx, _, length = item
+                        catalog.chunk_archived(fullname, idx, self.volume.num, length, digest, member)
+                        self.data += length
+                        with set_lock:
+                            counts['bytes_in'] += length
+                        continue
+                    catalog.archived(fullname.rstrip(os.path.sep) or os.path.sep, int(stat_buf.st_mtime),
+                                     self.volume.num, stat_buf.st_size if stat.S_ISREG(stat_buf.st_mode) else 0,
+                                     self.volume.digests.pop(fullname, None), inode(stat_buf), member)
+                    if stat.S_ISREG(stat_buf.st_mode):
+                        self.data += stat_buf.st_size
+                    with set_lock:
+                        counts['backed_up'] += 1
+                        if stat.S_ISREG(stat_buf.st_mode):
+                            counts['bytes_in'] += stat_buf.st_size
+        except Exception as ex:
+            logging.error(f'archive writer failed: {ex}')
+            error_list.append(f'archive writer failed: {ex}')
+            self.failed = True
+            # keep the scan from blocking on a full queue
+            while self.queue.get() is not None:
+                self.volume.size_check.acknowledged(0)
+        finally:
+            try:
+                # the next stage sees the end of the archive
+                self.out.out.close()
+            except OSError:
+                self.failed = True
+            self.cpu = time.thread_time()
+
+
+compression_suffix = {'xz': '.xz', 'zstd': '.zst', 'none': ''}
+"""file name suffix of each compression"""
+
+
+def compression_threads() -> int:
+    """
+    threads of each compression, 0 in the config shares the cores among the pipelines
+    """
+    threads = int(config['compression_threads'])
+    if threads == 0:
+        threads = max((os.cpu_count() or 1) // int(config['pipelines']), 1)
+    return threads
+
+
+def compression_args(threads: int = 0):
+    """
+    returns the command line of the configured compression, None for no compression;
+    threads 0 takes compression_threads
+    """
+    codec = config['compression']
+    level = int(config['compression_level'])
+    threads = threads or compression_threads()
+    block = parse_size(config['compression_block'], 8 * 1024 * 1024)
+    if codec == 'xz':
+        return ['xz', f'-{level}', f'-T{threads}', f'--block-size={block}', '-c']
+    if codec == 'zstd':
+        args = ['zstd', f'-{level}', f'-T{threads}', f'-B{block}', '-q', '-c']
+        if level > 19:
+            args.insert(1, '--ultra')
+        return args
+    if codec == 'none':
+        return None
+    raise ValueError(f'unknown compression {codec}')
+
+
+def pipeline_lag() -> int:
+    """
+    bytes the compression and the pipes may hold before their output reaches the target:
+    each thread works on a block while the next one is read
+    """
+    lag = 1024 * 1024
+    if frame_size > 0:
+        # the frame being filled, those in the workers and the one waiting for its turn
+        return lag + (compression_threads() + 2) * frame_size
+    if config['compression'] != 'none':
+        threads = compression_threads()
+        lag += (threads + 1) * parse_size(config['compression_block'], 8 * 1024 * 1024)
+    return lag
+
+
+def limit_lag():
+    """
+    cuts the compression block, down to 1M, and then the threads of the compression or of the frames, so the data
+    held back in the pipeline stays below MAX_LAG_SHARE of max_target_size; the size check keeps room for all
+    of it until it measures how much the compression has done
+    """
+    limit = MAX_LAG_SHARE * parse_size(config['max_target_size'], 500 * 1024 * 1024)
+    lag = pipeline_lag()
+    if lag <= limit or config['compression'] == 'none' and frame_size == 0:
+        return
+    threads = compression_threads()
+    if frame_size == 0:
+        block = parse_size(config['compression_block'], 8 * 1024 * 1024)
+        block = max(min(block, int((limit - 1024 * 1024) / (threads + 1))), 1024 * 1024)
+        config['compression_block'] = block
+        threads = max(min(threads, int((limit - 1024 * 1024) / block) - 1), 1)
+    else:
+        threads = max(min(threads, int((limit - 1024 * 1024) / frame_size) - 2), 1)
+    config['compression_threads'] = threads
+    logging.warning(f"the pipeline would hold back {lag} bytes of a {config['max_target_size']} volume, using "
+                    f"{threads} threads{'' if frame_size else ' and blocks of ' + str(config['compression_block'])}"
+                    f" to hold back {pipeline_lag()}")
+
+
+def gpg_args() -> list[str]:
+    return ['gpg', '-c', '--symmetric', '--batch', '--cipher-algo', 'TWOFISH', '--compress-algo', 'none',
+            '--passphrase', config['key']]
+
+
+def start_pipeline(target: BinaryIO, with_tar: bool) -> list[Stage]:
+    """
+    starts tar | compression | gpg writing into target, without tar the archive is written in process;
+    compressing ahead of the encryption, gpg gets already compressed data and does not compress itself
+    """
+    result = []
+    if with_tar:
+        # tar exits with 1 if a file changed while being read, which still gives a valid archive
+        # the messages of tar are parsed, its file names keep the locale
+        env = dict(os.environ)
+        if 'LC_ALL' in env:
+            env['LC_CTYPE'] = env.pop('LC_ALL')
+        env['LC_MESSAGES'] = 'C'
+        args = ['tar', '-cv', '--no-recursion', '--verbatim-files-from', '-T', '-']
+        if sparse_files:
+            args.insert(2, '--sparse')
+        result.append(Stage('tar', args, ok_codes=(0, 1), cwd='/', encoding='UTF-8', bufsize=0, env=env))
+    comp_args = compression_args()
+    if comp_args is not None:
+        result.append(Stage(config['compression'], comp_args, bufsize=0))
+    result.append(Stage('gpg', gpg_args(), bufsize=0))
+    if not with_tar:
+        # buffered, the archive writer flushes after each member
+        result[0].popen_args['bufsize'] = -1
+    stdin = subprocess.PIPE
+    for stage in result:
+        stdout = target if stage is result[-1] else subprocess.PIPE
+        stage.start(stdin, stdout)
+        if stdin != subprocess.PIPE:
+            # the stage holds the pipe now
+            stdin.close()
+        stdin = stage.proc.stdout
+    return result
+
+
+FRAME_HEADER = struct.Struct('>4sQ')
+"""magic and length of the encrypted frame following"""
+FRAME_MAGIC = b'PBF1'
+
+
+def seal_frame(data: bytes) -> bytes:
+    """
+    compresses and encrypts a frame on its own, with one compression thread as frames run side by side
+    """
+    comp_args = compression_args(1)
+    if comp_args is not None:
+        data = subprocess.run(comp_args, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+    return subprocess.run(gpg_args(), input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+
+
+class FrameWriter:
+    """
+    cuts the archive into frames of frame_size bytes, compresses and encrypts them in compression_threads
+    workers and writes them to the target in order, each behind a header with its length;
+    remembers where each frame starts in the archive and in the target
+    """
+
+    def __init__(self, target: BinaryIO):
+        self.target = target
+        self.buffer = bytearray()
+        self.pos = 0
+        """archive bytes handed to the workers"""
+        self.workers = compression_threads()
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='frame')
+        self.sealing: collections.deque = collections.deque()
+        """frames in the workers, in archive order"""
+        self.index: list[tuple[int, int, int, int]] = []
+        """position and length in the archive, start and size in the target of each frame written"""
+        self.started = time.monotonic()
+        self.ended = 0.0
+        self.failed = False
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        while len(self.buffer) >= frame_size:
+            self.seal(bytes(self.buffer[:frame_size]))
+            del self.buffer[:frame_size]
+        return len(data)
+
+    def flush(self):
+        # frames are written as they are done
+        while len(self.sealing) > 0 and self.sealing[0][2].done():
+            self.store()
+
+    def seal(self, frame: bytes):
+        while len(self.sealing) > self.workers:
+            self.store()
+        self.sealing.append((self.pos, len(frame), self.pool.submit(seal_frame, frame)))
+        self.pos += len(frame)
+
+    def store(self):
+        """
+        writes the oldest frame once it is sealed
+        """
+        pos, length, future = self.sealing.popleft()
+        try:
+            sealed = future.result()
+        except subprocess.CalledProcessError as ex:
+            self.failed = True
+            raise OSError(f'sealing the frame at {pos} failed: {ex.stderr.decode(errors="replace").strip()}')
+        start = self.target.tell()
+        self.target.write(FRAME_HEADER.pack(FRAME_MAGIC, len(sealed)))
+        self.target.write(sealed)
+        # the size check looks at the file
+        self.target.flush()
+        self.index.append((pos, length, start, FRAME_HEADER.size + len(sealed)))
+
+    def close(self):
+        """
+        seals what is left and waits for all frames to be written
+        """
+        try:
+            if len(self.buffer) > 0:
+                self.seal(bytes(self.buffer))
+                self.buffer.clear()
+            while len(self.sealing) > 0:
+                self.store()
+        finally:
+            self.pool.shutdown()
+            self.ended = time.monotonic()
+
+    def drained(self) -> int:
+        """
+        archive bytes of the frames written to the target
+        """
+        if len(self.index) == 0:
+            return 0
+        pos, length, _, _ = self.index[-1]
+        return pos + length
+
+    def report(self) -> dict:
+        # the work is done by the subprocesses of the workers, which are not timed one by one
+        return {'name': 'frames', 'seconds': self.ended - self.started, 'exit': 1 if self.failed else 0,
+                'cpu': None, 'bytes_in': self.pos, 'bytes_out': sum(size for _, _, _, size in self.index)}
+
+
+def target_name(num: int) -> str:
+    """
+    expands the target for volume num
+    """
+    target_fn = config['target']
+    target_fn = target_fn.replace('%h', platform.node())
+    target_fn = target_fn.replace('%n', str(num))
+    target_fn = target_fn.replace('%z', compression_suffix[config['compression']])
+    dt = datetime.datetime.now()
+    return target_fn.replace('%t', dt.strftime('%y-%m-%d_%H-%M-%S'))
+
+
+FS_IOC_FIEMAP = 0xC020660B
+"""ioctl mapping the extents of a file"""
+FIEMAP_HEADER = struct.Struct('=QQLLLL')
+"""struct fiemap: start, length, flags, mapped extents, extent count, reserved"""
+FIEMAP_EXTENT_SZ = 56
+
+
+def physical_offset(name: str) -> 'int | None':
+    """
+    where the first extent of a file lies on its device, None if the file system does not tell
+    """
+    request = bytearray(FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT_SZ))
+    try:
+        fd = os.open(name, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+        finally:
+            os.close(fd)
+    except OSError:
+        return None
+    if FIEMAP_HEADER.unpack_from(request)[3] == 0:
+        return None
+    # fe_logical, then fe_physical
+    return struct.unpack_from('=Q', request, FIEMAP_HEADER.size + 8)[0]
+
+
+def read_key(fullname: str, stat_buf: os.stat_result) -> tuple[int, int]:
+    """
+    sort key of a file in the read window: device and inode, or device and physical offset
+    """
+    if config['read_order'] == 'fiemap' and stat.S_ISREG(stat_buf.st_mode):
+        offset = physical_offset(fullname)
+        if offset is not None:
+            return stat_buf.st_dev, offset
+    return stat_buf.st_dev, stat_buf.st_ino
+
+
+def prefetch(names: list[str]):
+    """
+    asks the kernel to read the files ahead of the archiver
+    """
+    for name in names:
+        try:
+            fd = os.open(name, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+def drop_cache(fd: int, offset: int = 0, length: int = 0):
+    """
+    asks the kernel to drop a file from the page cache; dirty pages are written back first
+    """
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+
+
+def evict(name: str):
+    """
+    drops a file tar is done with from the page cache
+    """
+    try:
+        fd = os.open(name, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return
+    try:
+        drop_cache(fd)
+    finally:
+        os.close(fd)
+
+
+def lower_priority():
+    """
+    gives this process the lowest CPU and the idle I/O priority, inherited by the threads and stages started later
+    """
+    os.nice(19)
+    try:
+        subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())], check=True)
+    except (OSError, subprocess.CalledProcessError) as ex:
+        logging.warning(f'no idle I/O priority: {ex}')
+
+
+def io_pressure() -> 'float | None':
+    """
+    percentage of the last 10 s some tasks stalled on I/O, None without pressure stall information
+    """
+    try:
+        with open('/proc/pressure/io') as f:
+            return float(f.readline().split()[1].split('=')[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def process_usage(pid: int) -> tuple[int, int, float]:
+    """
+    bytes a process read and wrote, through any file or pipe, and the CPU seconds it used
+    """
+    with open(f'/proc/{pid}/io') as f:
+        chars = dict(line.split(':') for line in f)
+    with open(f'/proc/{pid}/stat') as f:
+        # the fields after the command name, which may hold blanks
+        fields = f.read().rsplit(')', 1)[1].split()
+    return int(chars['rchar']), int(chars['wchar']), (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def read_chars(pid: int, field: str = 'rchar') -> 'int | None':
+    """
+    bytes a process read (or wrote, with field wchar) so far, None once it is gone
+    """
+    try:
+        with open(f'/proc/{pid}/io') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+MIN_RATE = 256 * 1024
+"""bytes per second the throttle does not go below"""
+THROTTLE_TICK = 0.02
+"""seconds between looks at what tar read, tar reads a few MB in that time unthrottled"""
+
+
+class Throttle:
+    """
+    keeps what the archivers read below a rate: the python archiver waits in its reads, tar is stopped
+    with SIGSTOP until the rate allows what it read; the rate halves each second the host is loaded
+    and grows back by a quarter each second it is not
+    """
+
+    def __init__(self, limit: int, max_pressure: float, max_load: float):
+        self.limit = limit
+        self.rate = float(limit)
+        """bytes per second, 0 for no limit"""
+        self.max_pressure = max_pressure
+        self.max_load = max_load
+        self.allowance = 0.0
+        """bytes that may be read without waiting, negative when behind"""
+        self.last = time.monotonic()
+        self.read = 0
+        """bytes read since the last check of the load"""
+        self.paused = 0.0
+        """seconds the archivers waited in all"""
+        self.held = 0.0
+        """when an archiver last had to wait"""
+        self.lowest = 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='throttle', daemon=True)
+        self.thread.start()
+
+    def take(self, size: int) -> float:
+        """
+        accounts size bytes read, returns the seconds to wait for them; up to a second of reading is allowed ahead
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.read += size
+            if self.rate == 0:
+                self.last = now
+                return 0.0
+            self.allowance = min(self.allowance + (now - self.last) * self.rate, self.rate) - size
+            self.last = now
+            if self.allowance >= 0:
+                return 0.0
+            delay = -self.allowance / self.rate
+            self.held = now + delay
+            return delay
+
+    def wait(self, size: int):
+        delay = self.take(size)
+        if delay > 0:
+            time.sleep(delay)
+            with self.lock:
+                self.paused += delay
+
+    def holding(self) -> bool:
+        """
+        whether an archiver waited within the time the size check takes as a stall
+        """
+        return time.monotonic() - self.held < STALL_TIME
+
+    def loaded(self) -> bool:
+        if self.max_pressure > 0:
+            pressure = io_pressure()
+            if pressure is not None and pressure > self.max_pressure:
+                return True
+        return self.max_load > 0 and os.getloadavg()[0] / (os.cpu_count() or 1) > self.max_load
+
+    def adapt(self, elapsed: float):
+        """
+        sets the rate from the load of the host and what was read since the last check
+        """
+        with self.lock:
+            measured = self.read / elapsed
+            self.read = 0
+        if self.loaded():
+            rate = max((self.rate or measured) / 2, MIN_RATE)
+            self.lowest = min(self.lowest or rate, rate)
+        elif self.rate == 0:
+            return
+        elif self.limit > 0:
+            rate = min(self.rate * 1.25, self.limit)
+        elif measured < self.rate / 2:
+            # the archivers do not use the rate any more
+            rate = 0
+        else:
+            rate = self.rate * 1.25
+        if rate != self.rate:
+            logging.debug(f'I/O rate {rate / 1000000:.1f} MB/s, read {measured / 1000000:.1f} MB/s')
+        with self.lock:
+            self.rate = rate
+
+    def run(self):
+        """
+        accounts what the tar stages read, stopping them while the rate is behind;
+        checks the load each second and drops the volumes written from the page cache
+        """
+        seen = {}
+        """bytes read by each tar process"""
+        stopped = []
+        """tar processes held with SIGSTOP"""
+        stopped_at = 0.0
+        checked = time.monotonic()
+        try:
+            while not self.stopped.wait(THROTTLE_TICK):
+                tars = [volume.stages[0].proc for volume in list(open_volumes)
+                        if len(volume.stages) > 0 and volume.stages[0].name == 'tar']
+                read = 0
+                for proc in tars:
+                    chars = read_chars(proc.pid)
+                    if chars is not None:
+                        read += chars - seen.get(proc.pid, 0)
+                        seen[proc.pid] = chars
+                now = time.monotonic()
+                if self.take(read) > 0:
+                    if len(stopped) == 0:
+                        stopped_at = now
+                    for proc in tars:
+                        if proc not in stopped and proc.poll() is None:
+                            proc.send_signal(signal.SIGSTOP)
+                            stopped.append(proc)
+                elif len(stopped) > 0:
+                    self.resume(stopped)
+                    self.paused += now - stopped_at
+                if now - checked >= 1:
+                    self.adapt(now - checked)
+                    checked = now
+                    if low_impact:
+                        # starts writing the volumes back, what is clean leaves the cache
+                        for volume in list(open_volumes):
+                            if volume.file is not None and not volume.file.closed:
+                                drop_cache(volume.file.fileno())
+        finally:
+            self.resume(stopped)
 
+    @staticmethod
+    def resume(procs: list[subprocess.Popen]):
+        for proc in procs:
+            try:
+                proc.send_signal(signal.SIGCONT)
+            except ProcessLookupError:
+                pass
+        procs.clear()
 
-class SizeCheck:
-    def __init__(self, size: str, fd: int):
-        self.fd = fd
-        self.reserved = 0
-        size_pat = re.compile('(\\d+)([kmgGM])')
-        m = size_pat.search(size)
-        if m is not None:
-            s = int(m.group(1))
-            u = m.group(2)
-            if u == 'k':
-                s *= 1000
-            elif u == 'K':
-                s *= 1024
-            elif u == 'm':
-                s *= 1000000
-            elif u == 'M':
-                s *= 1024 * 1024
-            elif u == 'g':
-                s *= 1000 * 1000 * 1000
-            elif u == 'G':
-                s *= 1024 * 1024 * 1024
-            self.target = s
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class Volume:
+    """
+    a target file of this run with its pipeline, archiver and size check
+    """
+
+    def __init__(self, num: int, name: str, size: int):
+        self.num = num
+        self.name = name
+        self.target = size
+        self.file: BinaryIO = None
+        self.size_check: SizeCheck = None
+        self.stages: list[Stage] = []
+        """subprocesses of the pipeline: tar, compression if any, encryption"""
+        self.archiver: 'GnuTar | TarWriter' = None
+        """writes the archive into the first stage of the pipeline"""
+        self.readers = {}
+        """reader of each stage"""
+        self.tarring = set()
+        """names fed to tar and not yet reported"""
+        self.digests: dict[str, bytes] = {}
+        """content hashes of the admitted files, recorded with them"""
+        self.chunked: set['ChunkedFile'] = set()
+        """files with chunks in this volume"""
+        self.links: dict[str, int] = {}
+        """archive bytes reserved for the names tar is to store as hard links"""
+        self.window: list[tuple[tuple[int, int], str, os.stat_result]] = []
+        """admitted files not yet fed to the archiver, with their sort key"""
+        self.frames: 'FrameWriter | None' = None
+        """compresses and encrypts a framed volume in process"""
+        self.closed = False
+        self.size = 0
+        self.complete = False
+        self.stage_reports: list[dict] = []
+
+    def open(self):
+        """
+        registers the volume in the backup table, starts its pipeline and archiver
+        """
+        db_conn.execute('insert into backup(num,tarfile,started) values(?,?,?)', (self.num, self.name, time.time()))
+        db_conn.commit()
+        self.file = open(self.name, 'wb')
+        self.size_check = SizeCheck(self.target, self.file.fileno(), pipeline_lag())
+        with_tar = config['archiver'] == 'gnutar'
+        if frame_size > 0:
+            self.frames = FrameWriter(self.file)
         else:
-            self.target = 500 * 1024 * 1024
-        logging.debug(f"aiming at archive not exceeding {self.target} bytes")
+            self.stages = start_pipeline(self.file, with_tar)
+        if with_tar:
+            self.archiver = GnuTar(self)
+            self.size_check.held_back = 1
+            self.readers[self.stages[0]] = reader_pool.submit(handle_tar_stderr, self)
+        else:
+            self.archiver = TarWriter(self)
+        for stage in self.stages[1 if with_tar else 0:]:
+            self.readers[stage] = reader_pool.submit(handle_stage_errors, stage)
+        if self.frames is not None:
+            self.size_check.drained = self.frames.drained
+        elif config['compression'] != 'none':
+            self.size_check.drained = self.compressed
+
+    def compressed(self) -> 'int | None':
+        """
+        archive bytes the compression surely is done with: it wrote at least their output
+        """
+        stage = next(stage for stage in self.stages if stage.name == config['compression'])
+        written = read_chars(stage.proc.pid, 'wchar')
+        return None if written is None else int(written / MAX_EXPANSION)
 
-    def reserve(self, size: int):
-        nsz = size + HEADER_SZ + self.reserved
-        if nsz >= self.target:
+    def reserve(self, size: int, wait: bool) -> bool:
+        """
+        reserves archive bytes; the read window goes to the archiver before waiting for it to make room
+        """
+        if self.size_check.reserve(size, False):
+            return True
+        if not wait:
             return False
-        self.reserved += size + HEADER_SZ
+        self.flush_window()
+        return self.size_check.reserve(size, True)
+
+    def feed(self, fullname: str, stat_buf: os.stat_result):
+        """
+        hands an admitted file to the archiver, through the read window if there is one
+        """
+        window = int(config['read_window'])
+        if window <= 1:
+            self.archiver.add(fullname, stat_buf)
+            return
+        self.window.append((read_key(fullname, stat_buf), fullname, stat_buf))
+        if len(self.window) >= window:
+            self.flush_window()
+
+    def flush_window(self):
+        """
+        feeds the read window to the archiver in the order of the disk, the small files prefetched;
+        names of one inode keep their order, so links follow the file they point to
+        """
+        if len(self.window) == 0:
+            return
+        self.window.sort(key=lambda item: item[0])
+        if readahead is not None:
+            limit = parse_size(config['readahead_size'], 1024 * 1024)
+            readahead.submit(prefetch, [name for _, name, stat_buf in self.window
+                                        if stat.S_ISREG(stat_buf.st_mode) and stat_buf.st_size <= limit])
+        for _, fullname, stat_buf in self.window:
+            self.archiver.add(fullname, stat_buf)
+        self.window.clear()
+
+    def close(self):
+        """
+        ends the pipeline, syncs the target and marks the files of the volume as backed up
+        """
+        self.flush_window()
+        # each stage ends after the one feeding it, its error output reaches EOF when it exits
+        self.archiver.close()
+        for stage in self.stages:
+            stage.wait()
+            self.readers[stage].result()
+        # the volume must be on disk before its files are marked as backed up
+        os.fsync(self.file.fileno())
+        if low_impact:
+            drop_cache(self.file.fileno())
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.file.close()
+        self.closed = True
+        others = [stage for stage in self.stages if stage.name != 'tar']
+        self.complete = self.archiver.completed() and all(stage.succeeded() for stage in others)
+        self.stage_reports = [self.archiver.report()] + [stage.report() for stage in others]
+        if self.frames is not None:
+            self.stage_reports.append(self.frames.report())
+        if not self.complete:
+            error_list.append(f'volume {self.name} is incomplete, its files stay unmarked')
+        catalog.promote(self.num, self.complete)
+        if self.complete:
+            db_conn.execute('update backup set bytes=(select coalesce(sum(size), 0) from files where volume=?) '
+                            '+ (select coalesce(sum(size), 0) from chunks where volume=?), size=? where num=?',
+                            (self.num, self.num, self.size, self.num))
+            if self.frames is not None:
+                db_conn.executemany('insert into frames(volume, pos, length, start, size) values(?,?,?,?,?)',
+                                    [(self.num, *frame) for frame in self.frames.index])
+            db_conn.commit()
+        for chunked in self.chunked:
+            chunked.volume_closed(self)
+        for fn in self.tarring:
+            logging.debug(f" not yet {fn}")
+        logging.debug(f"volume {self.num} closed with {self.size} bytes")
+
+    def budget(self) -> int:
+        """
+        bytes the volume takes from the run at most
+        """
+        return self.size if self.closed else self.target
+
+
+def new_volume() -> 'Volume | None':
+    """
+    starts the next volume of the run, None if the run may not write another
+    """
+    global vol_num
+    if len(volumes) >= int(config['max_volumes']):
+        return None
+    size = parse_size(config['max_target_size'], 500 * 1024 * 1024)
+    run_size = parse_size(config['max_run_size'], 0)
+    if run_size > 0:
+        size = min(size, run_size - sum(volume.budget() for volume in volumes))
+        if size < 2 * TAIL_SZ:
+            msg_list.append(f'run size of {run_size} bytes reached')
+            return None
+    with vol_lock:
+        target_fn = target_name(vol_num)
+        if any(volume.name == target_fn for volume in volumes):
+            error_list.append(f'target {target_fn} would be written twice, it needs %n to write further volumes')
+            return None
+        volume = Volume(vol_num, target_fn, size)
+        vol_num += 1
+    volume.open()
+    volumes.append(volume)
+    open_volumes.append(volume)
+    return volume
+
+
+def roll_volume(volume: Volume) -> bool:
+    """
+    closes a volume and starts the next one in its place, if the run may write another;
+    the deferred files go first into the new one
+    """
+    global deferred
+    volume.close()
+    open_volumes.remove(volume)
+    successor = new_volume()
+    if successor is None:
+        return False
+    carried = deferred
+    deferred = []
+    for fullname, stat_buf, digest in carried:
+        if admit(fullname, stat_buf, 'incremental', digest):
+            continue
+        if successor.size_check.reserved == 0:
+            logging.warning(f'{fullname} does not fit into a volume')
+        else:
+            deferred.append((fullname, stat_buf, digest))
+    return True
+
+
+def volumes_full() -> bool:
+    """
+    rolls the filled volumes over, or the fullest one if enough files are waiting for the next volume;
+    true if no volume is left to take files
+    """
+    for volume in list(open_volumes):
+        if volume.size_check.is_filled():
+            roll_volume(volume)
+    if len(deferred) >= MAX_DEFERRED and len(open_volumes) > 0:
+        roll_volume(max(open_volumes, key=lambda v: v.size_check.reserved))
+    return len(open_volumes) == 0
+
+
+def pick_volume(size: int) -> 'Volume | None':
+    """
+    reserves size archive bytes in the least busy volume they fit into;
+    waits for a volume to drain only if none takes them right away
+    """
+    candidates = sorted(open_volumes, key=lambda v: v.size_check.pending())
+    for wait in (False, True):
+        for volume in candidates:
+            if volume.reserve(size, wait):
+                return volume
+    return None
+
+
+def admit(fullname: str, stat_buf: os.stat_result, kind: str, digest: 'bytes | None' = None) -> bool:
+    """
+    hands a file to a volume, kind is the count it adds to;
+    another name of a file this run put into a volume still open goes there, tar stores it as a link
+    """
+    key = inode(stat_buf)
+    volume, first = run_inodes.get(key, (None, None))
+    size = header_size(fullname) + header_size(first or '')
+    if volume in open_volumes and volume.reserve(size, True):
+        logging.debug(f"backing up: {fullname} linked to {first}")
+        volume.links[fullname] = size
+        run_names.add(fullname)
+        counts[kind] += 1
+        counts['linked'] += 1
+        counts['link_bytes'] += stat_buf.st_size
+        volume.feed(fullname, stat_buf)
         return True
+    volume = pick_volume(member_size(fullname, stat_buf))
+    if volume is None:
+        return False
+    logging.debug(f"backing up: {fullname}")
+    counts[kind] += 1
+    if digest is not None:
+        volume.digests[fullname] = digest
+        run_digests[digest] = volume.num
+    if key is not None:
+        run_inodes[key] = (volume, fullname)
+    run_names.add(fullname)
+    volume.feed(fullname, stat_buf)
+    return True
 
-    def is_filled(self):
-        if self.reserved >= self.target:
-            return True
+
+def link_archived(fullname: str, stat_buf: os.stat_result) -> bool:
+    """
+    records a new name of a file with several links as a reference if the catalog holds another name of it
+    with the same mtime and size, as snapshot directories made of hard links have
+    """
+    row = db_conn.execute('select max(volume) from files where ino=? and dev=? and mtime=? and size=?',
+                          (stat_buf.st_ino, stat_buf.st_dev, int(stat_buf.st_mtime), stat_buf.st_size)).fetchone()
+    if row[0] is None:
         return False
+    logging.debug(f'hard link: {fullname}')
+    catalog.duplicate(fullname, int(stat_buf.st_mtime), stat_buf.st_size, None, row[0], inode(stat_buf))
+    counts['linked'] += 1
+    counts['link_bytes'] += stat_buf.st_size
+    return True
 
 
-target_sc: SizeCheck
+class ChunkedFile:
+    """
+    a large file archived in chunks by this run; it counts as backed up once all volumes holding its new chunks
+    are written, and stays changed for the next run if one of them fails
+    """
 
+    def __init__(self, name: str, stat_buf: os.stat_result, chunks: int):
+        self.name = name
+        self.mtime = int(stat_buf.st_mtime)
+        self.size = stat_buf.st_size
+        self.chunks = chunks
+        self.volumes: set[int] = set()
+        """volumes holding chunks not yet promoted"""
+        self.admitted = False
+        """all changed chunks are in volumes"""
+        self.failed = False
 
-def prep_database():
+    def volume_closed(self, volume: Volume):
+        self.volumes.discard(volume.num)
+        self.failed = self.failed or not volume.complete
+        self.settle()
+
+    def settle(self):
+        if self.admitted and not self.failed and len(self.volumes) == 0:
+            catalog.chunked(self.name, self.mtime, self.size, self.chunks)
+
+
+def chunk_digest(name: str, offset: int, length: int) -> 'bytes | None':
     """
-    prepares the database
+    hash of length bytes from offset of a file, None if it cannot be read
     """
-    global db_conn, vol_num
-    version: int = 0
+    digest = hashlib.blake2b(digest_size=16)
     try:
-        row = db_conn.execute('select max(version) from dbv').fetchone()
-        if row is not None:
-            version = row[0]
-    except sqlite3.DatabaseError:
-        logging.info('db has no version')
-    if version == 0:
-        logging.info("creating db from scratch")
-        schema_stmts = [
-            'CREATE TABLE files (name TEXT NOT NULL, mtime REAL NOT NULL,volume INTEGER)',
-            'CREATE UNIQUE INDEX "prime" on files (name ASC)',
-            'CREATE INDEX vols on files (volume ASC)',
-            'CREATE TABLE backup (num INTEGER NOT NULL, tarfile TEXT NOT NULL)',
-            'CREATE INDEX bknum on backup (num ASC)',
-            'CREATE TABLE dbv(version INTEGER NOT NULL)',
-            'insert into dbv values(1)'
-        ]
-        for stmt in schema_stmts:
-            db_conn.execute(stmt)
-        db_conn.commit()
-    row = db_conn.execute('select max(volume) from files').fetchone()
-    if row is not None and row[0] is not None:
-        vol_num = row[0] + 1
+        with open(name, 'rb') as f:
+            f.seek(offset)
+            left = length
+            while left > 0 and (block := f.read(min(left, 1024 * 1024))):
+                digest.update(block)
+                left -= len(block)
+    except OSError:
+        return None
+    return digest.digest()
 
 
-def handle_tar_stderr():
-    global error_list, tarring, tar_proc, db_lock, set_lock, counts
+def admit_chunk(fullname: str, idx: int, offset: int, length: int, chunked: 'ChunkedFile | None',
+                extents: 'list[tuple[int, int]] | None' = None) -> bool:
+    """
+    hands a chunk to a volume; for the incremental backup, the chunked file given,
+    the fullest volume is rolled over if none takes it
+    """
+    size = chunk_member_size(fullname, length, extents)
     while True:
-        line = tar_proc.stderr.readline()
-        if not line:
-            logging.debug("tar pipe closed")
-            return
-        line = line.strip()
-        if line.endswith('/'):
-            line = line[:-1]
-        # outcomes:
-        # 1. - directory/ - no beginning "/", but ending "/"
-        # 2. - file  - no beginning "/", no ending "/"
-        # something else
-        with set_lock:
-            found = line in tarring
-        if found:
-            with set_lock:
-                tarring.remove(line)
-            # adding the '/' at the beginning
-            line = os.path.sep + line
-            statbuf = os.lstat(line)
-            mtime = int(statbuf.st_mtime)
-            with db_lock:
-                db_conn.execute('replace into files(name,mtime,volume) values(?,?,?)', (line, mtime, vol_num))
-                db_conn.commit()
-                counts['backed_up'] += 1
-        else:
-            print(f"tar stderr {line}")
-            error_list.append(line)
+        volume = pick_volume(size)
+        if volume is not None:
+            break
+        if chunked is None or int(config['max_volumes']) <= 1 or len(open_volumes) == 0:
+            return False
+        fullest = max(open_volumes, key=lambda v: v.size_check.reserved)
+        if fullest.size_check.reserved == 0 or not roll_volume(fullest):
+            return False
+    logging.debug(f"backing up: {fullname} chunk {idx}")
+    run_names.add((fullname, idx))
+    counts['chunks'] += 1
+    if chunked is not None:
+        chunked.volumes.add(volume.num)
+        volume.chunked.add(chunked)
+    volume.archiver.add_chunk(fullname, idx, offset, length)
+    return True
 
 
-def handle_enc_errors():
-    global error_list, enc_proc
-    while True:
-        line = enc_proc.stderr.readline()
-        if not line:
-            logging.debug("encryption pipe closed")
-            return
-        line = line.strip()
-        if len(line) == 0:
-            return
-        print(f"enc stderr {line}")
-        error_list.append(line)
+def archive_chunked(fullname: str, stat_buf: os.stat_result):
+    """
+    archives the chunks of a large file whose hash differs from the catalog, spread over the volumes;
+    chunks left over when the run ends follow in the next one
+    """
+    length = parse_size(config['chunk_size'], 64 * 1024 * 1024)
+    path, base = os.path.split(fullname)
+    known = dict(db_conn.execute('select c.idx, c.hash from chunks as c join dirs as d on d.id=c.dir_id '
+                                 'where d.path=? and c.base=?', (path, base)))
+    offsets = range(0, stat_buf.st_size, length)
+    # hashed ahead in the hasher processes if there are any
+    digester = hasher.pool.map if hasher is not None else map
+    digests = digester(chunk_digest, repeat(fullname), offsets, repeat(length))
+    chunked = ChunkedFile(fullname, stat_buf, len(offsets))
+    extents = file_extents(fullname, stat_buf.st_size) if is_sparse(stat_buf) else None
+    changed = 0
+    for idx, (offset, digest) in enumerate(zip(offsets, digests)):
+        if digest is not None and known.get(idx) == digest:
+            continue
+        size = min(length, stat_buf.st_size - offset)
+        if not admit_chunk(fullname, idx, offset, size, chunked, chunk_extents(extents, offset, size)):
+            logging.warning(f'{fullname}: chunk {idx} does not fit, the rest follows in the next run')
+            chunked.failed = True
+            unsettle(fullname)
+            break
+        changed += 1
+    if changed > 0:
+        counts['incremental'] += 1
+    logging.debug(f'{fullname}: {changed} of {len(offsets)} chunks changed')
+    chunked.admitted = True
+    chunked.settle()
 
 
-def handle_xz_errors():
-    global error_list, xz_proc
-    while True:
-        line = xz_proc.stderr.readline()
-        if not line:
-            logging.debug("compression pipe closed")
-            return
-        line = line.strip()
-        if len(line) == 0:
-            return
-        print(f"enc stderr {line}")
-        error_list.append(line)
+def recycle_chunk(fullname: str, stat_buf: os.stat_result, idx: int, digest: bytes):
+    """
+    archives a chunk again for the cyclic backup if it still holds what the catalog says,
+    otherwise the file is left to the next incremental backup
+    """
+    length = parse_size(config['chunk_size'], 64 * 1024 * 1024)
+    offset = idx * length
+    if offset >= stat_buf.st_size or chunk_digest(fullname, offset, length) != digest:
+        catalog.touched(fullname, -1)
+        return
+    size = min(length, stat_buf.st_size - offset)
+    extents = file_extents(fullname, stat_buf.st_size) if is_sparse(stat_buf) else None
+    admit_chunk(fullname, idx, offset, size, None, chunk_extents(extents, offset, size))
+
+
+CYCLIC_BATCH = 200
+"""catalog rows the cyclic planner reads at a time"""
+
+
+def cyclic_room() -> int:
+    """
+    largest file one of the open volumes may still take
+    """
+    return max((volume.size_check.room() for volume in open_volumes), default=0)
+
+
+def volume_usage(below: int) -> list[dict]:
+    """
+    live bytes of the volumes numbered below the given one against the bytes they were written with,
+    with the part of the volume file that could be freed; one pass over the (volume, size) index
+    """
+    written = {row[0]: row[1:] for row in db_conn.execute('select num, tarfile, bytes, size from backup where num < ?',
+                                                          (below,))}
+    chunks = {row[0]: row[1] for row in db_conn.execute('select volume, sum(size) from chunks where volume < ? '
+                                                         'group by volume', (below,))}
+    usage = []
+    rows = db_conn.execute('select volume, count(*), sum(size) from files where volume < ? '
+                           'group by volume order by volume', (below,)).fetchall()
+    # volumes holding nothing but chunks
+    listed = set(row[0] for row in rows)
+    rows += [(volume, 0, 0) for volume in chunks if volume not in listed]
+    for volume, files, live in sorted(rows):
+        live = (live or 0) + chunks.get(volume, 0)
+        tarfile, total, size = written.get(volume, (None, None, None))
+        # volumes from before the sizes were recorded count as fully live
+        ratio = min(live / total, 1.0) if total else 1.0
+        usage.append({'num': volume, 'tarfile': tarfile, 'files': files, 'live': ratio, 'size': size or 0,
+                      'reclaimable': int((size or 0) * (1 - ratio))})
+    return usage
+
+
+def cyclic_order() -> list[int]:
+    """
+    volumes to take files from: those with less than compact_below of their bytes live first, sparsest first,
+    so they become deletable early, then the others from the oldest
+    """
+    threshold = float(config['compact_below'])
+    usage = volume_usage(first_vol)
+    sparse = sorted((volume for volume in usage if volume['live'] < threshold), key=lambda v: (v['live'], v['num']))
+    for volume in sparse:
+        logging.debug(f"compacting volume {volume['num']}, {volume['live'] * 100:.0f}% live")
+    return [volume['num'] for volume in sparse] + [volume['num'] for volume in usage if volume['live'] >= threshold]
+
+
+def plan_cyclic():
+    """
+    yields the files to archive again with their content hash and the chunk index for chunks of large files,
+    volume by volume in cyclic_order; chunks go first;
+    within a volume the largest files still fitting come first and the smaller ones fill up the rest,
+    files larger than the room left are skipped on the (volume, size) index without reading them
+    """
+    for volume in cyclic_order():
+        last_rowid = 0
+        while True:
+            rows = db_conn.execute('select c.rowid, d.path, c.base, c.idx, c.size, c.hash from chunks as c '
+                                   'join dirs as d on d.id=c.dir_id where c.volume = ? and c.rowid > ? '
+                                   'order by c.rowid limit ?', (volume, last_rowid, CYCLIC_BATCH)).fetchall()
+            if len(rows) == 0 or chunk_member_size(rows[0][2], rows[0][4]) > cyclic_room():
+                break
+            for rowid, path, base, idx, size, digest in rows:
+                if chunk_member_size(base, size) > cyclic_room():
+                    break
+                yield os.path.join(path, base), digest, idx
+            last_rowid = rows[-1][0]
+        # files archived before their size was recorded
+        last_rowid = 0
+        while True:
+            rows = db_conn.execute('select f.rowid, d.path, f.base, f.hash from files as f join dirs as d on d.id=f.dir_id '
+                                   'where f.volume = ? and f.size is null and f.rowid > ? order by f.rowid limit ?',
+                                   (volume, last_rowid, CYCLIC_BATCH)).fetchall()
+            if len(rows) == 0:
+                break
+            for rowid, path, base, digest in rows:
+                yield os.path.join(path, base), digest, None
+            last_rowid = rows[-1][0]
+        key = (sys.maxsize, sys.maxsize)
+        """(size, rowid) of the last file read"""
+        while True:
+            room = cyclic_room()
+            if room < HEADER_SZ:
+                return
+            key = min(key, (room, sys.maxsize))
+            rows = db_conn.execute('select f.rowid, d.path, f.base, f.size, f.hash from files as f '
+                                   'join dirs as d on d.id=f.dir_id '
+                                   'where f.volume = ? and (f.size, f.rowid) < (?, ?) '
+                                   'order by f.size desc, f.rowid desc limit ?', (volume, *key, CYCLIC_BATCH)).fetchall()
+            if len(rows) == 0:
+                break
+            for rowid, path, base, size, digest in rows:
+                if size > cyclic_room():
+                    break
+                key = (size, rowid)
+                yield os.path.join(path, base), digest, None
+
+
+def file_digest(name: str) -> 'bytes | None':
+    """
+    hash of the content of a file, None if it cannot be read or changes meanwhile; runs in the hasher processes
+    """
+    try:
+        before = os.stat(name)
+        digest = hashlib.blake2b(digest_size=16)
+        with open(name, 'rb') as f:
+            while block := f.read(1024 * 1024):
+                digest.update(block)
+        after = os.stat(name)
+    except OSError:
+        return None
+    if (before.st_mtime_ns, before.st_size) != (after.st_mtime_ns, after.st_size):
+        return None
+    return digest.digest()
+
+
+class Hasher:
+    """
+    hashes changed files in a pool of processes while the scan goes on;
+    results are taken in the order the files were submitted, another name of a file in flight shares its hash
+    """
+
+    def __init__(self):
+        workers = int(config['hash_workers']) or os.cpu_count() or 1
+        self.min_size = parse_size(config['hash_min_size'], 64 * 1024)
+        # spawned, forking would copy the threads of the scan and the pipelines
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.queue = collections.deque()
+        self.window = 4 * workers
+        """files in flight before the scan waits for the oldest"""
+        self.inodes: dict[tuple[int, int], Future] = {}
+        """hash of each file with several links in flight, by device and inode"""
+
+    def submit(self, fullname: str, stat_buf: os.stat_result):
+        key = inode(stat_buf)
+        future = self.inodes.get(key)
+        if future is None:
+            future = self.pool.submit(file_digest, fullname)
+            if key is not None:
+                self.inodes[key] = future
+        self.queue.append((fullname, stat_buf, future))
+
+    def ready(self, wait: bool):
+        """
+        yields (name, stat, hash) of the files hashed so far, of all of them if wait
+        """
+        while len(self.queue) > 0 and (wait or len(self.queue) > self.window or self.queue[0][2].done()):
+            fullname, stat_buf, future = self.queue.popleft()
+            # names after this one are settled after it and find it in run_inodes once admitted
+            self.inodes.pop(inode(stat_buf), None)
+            yield fullname, stat_buf, future.result()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
 
 
 def remove_file(fn: str):
-    global db_conn, db_lock, counts
-    with db_lock:
-        try:
-            db_conn.execute('delete from files where name=?', (fn,))
-            db_conn.commit()
-            counts['removed'] += 1
-        except Exception as ex:
-            logging.error(f'exception {ex}')
+    global catalog, counts
+    catalog.removed(fn)
+    counts['removed'] += 1
 
 
-def do_incremental(fullname):
-    global blacklist, cnt_excluded, excluding, config, start_device, \
-        counts, tarring, target_sc, set_lock
-    for bl_item in blacklist:
-        if fullname.startswith(bl_item):
-            counts['excluded'] += 1
-            return
-    stat_buf = os.lstat(fullname)
+def do_incremental(fullname: str, stat_buf: os.stat_result):
+    global blacklist, cnt_excluded, excluding, config, start_device, counts
+    if blacklist.covers(fullname):
+        counts['excluded'] += 1
+        return
     # adding additional / at the end for directory patterns
     if stat.S_ISDIR(stat_buf.st_mode):
         ext_fullname = fullname + '/'
     else:
         ext_fullname = fullname
-    for pattern in excluding:
-        m = pattern.search(ext_fullname)
-        if m is not None:
-            counts['excluded'] += 1
-            return
+    if excluding.search(ext_fullname):
+        counts['excluded'] += 1
+        return
     # no need to count those
     if fullname == config['db']:
         return
-    if fullname == config['target']:
+    if any(fullname == volume.name for volume in volumes):
         return
     if stat_buf.st_dev != start_device:
         return
@@ -271,9 +2604,10 @@ def do_incremental(fullname):
     mtime = int(stat_buf.st_mtime)
     if mtime > max_age:
         counts['too_recent'] += 1
+        unsettle(fullname)
         return
     # checking age against database
-    row = db_conn.execute('select mtime from files where name=?', (fullname,)).fetchone()
+    row = catalog_index.lookup(fullname)
     if row is not None:
         if row[0] == mtime:
             # logging.debug('same old file: ' + fullname)
@@ -283,103 +2617,435 @@ def do_incremental(fullname):
         logging.warning('missing permissions: ' + fullname)
         counts['permissions'] += 1
         return
-    if target_sc.reserve(stat_buf.st_size):
-        logging.debug(f"backing up: {fullname}")
-        counts['incremental'] += 1
-        # removing the leading '/' so tar does not complain
-        fullname = fullname[1:]
-        with set_lock:
-            tarring.add(fullname)
-        print(fullname, file=tar_proc.stdin, flush=True)
-    else:
-        logging.debug(f"size too big for {fullname}, skipping until next round")
+    if chunk_above > 0 and stat.S_ISREG(stat_buf.st_mode) and stat_buf.st_size >= chunk_above:
+        archive_chunked(fullname, stat_buf)
+        return
+    if inode(stat_buf) is not None and link_archived(fullname, stat_buf):
+        return
+    if inode(stat_buf) in run_inodes:
+        # another name of a file this run archived, admit links it
+        archive_changed(fullname, stat_buf, None)
+        return
+    if hasher is not None and stat.S_ISREG(stat_buf.st_mode) and stat_buf.st_size >= hasher.min_size:
+        hasher.submit(fullname, stat_buf)
+        for hashed in hasher.ready(False):
+            settle_hashed(*hashed)
+        return
+    archive_changed(fullname, stat_buf, None)
+
+
+def archive_changed(fullname: str, stat_buf: os.stat_result, digest: 'bytes | None'):
+    if not admit(fullname, stat_buf, 'incremental', digest):
+        logging.debug(f"size too big for {fullname}, skipping until next volume")
+        unsettle(fullname)
+        if int(config['max_volumes']) > 1:
+            deferred.append((fullname, stat_buf, digest))
 
 
-def do_cyclic(fullname: str):
-    global blacklist, excluding, tarring, tar_proc, target_sc, set_lock, counts
+def settle_hashed(fullname: str, stat_buf: os.stat_result, digest: 'bytes | None'):
+    """
+    decides on a changed file once its content hash is known: the same content as in the catalog only updates
+    the mtime, content archived under another name is recorded as a duplicate, anything else gets archived
+    """
+    if digest is not None:
+        mtime = int(stat_buf.st_mtime)
+        path, base = os.path.split(fullname)
+        row = db_conn.execute('select hash, volume, src from files where dir_id=(select id from dirs where path=?) '
+                              'and base=?', (path, base)).fetchone()
+        if row is not None and row[0] == digest and (row[1] is not None or row[2] is not None):
+            catalog.touched(fullname, mtime)
+            counts['unchanged'] += 1
+            return
+        if inode(stat_buf) in run_inodes:
+            # another name of a file admitted while this one was hashed
+            archive_changed(fullname, stat_buf, digest)
+            return
+        src = run_digests.get(digest)
+        if src is None:
+            src = db_conn.execute('select max(volume) from files where hash=?', (digest,)).fetchone()[0]
+        if src is not None:
+            logging.debug(f'duplicate: {fullname}')
+            catalog.duplicate(fullname, mtime, stat_buf.st_size, digest, src, inode(stat_buf))
+            counts['deduplicated'] += 1
+            return
+    archive_changed(fullname, stat_buf, digest)
+
+
+def repoint_duplicates():
+    """
+    points each duplicate and hard link at the newest volume holding its content, so older volumes become deletable;
+    those whose content is in no volume any more lose their mtime and get archived again
+    """
+    with db_conn:
+        db_conn.execute('update files set src=(select max(c.volume) from files as c where c.hash=files.hash) '
+                        'where volume is null and hash is not null')
+        db_conn.execute('update files set src=(select max(c.volume) from files as c where c.ino=files.ino '
+                        'and c.dev=files.dev and c.mtime=files.mtime) where volume is null and hash is null '
+                        'and ino is not null')
+        orphans = db_conn.execute('update files set mtime=-1 where volume is null and src is null '
+                                  'and (hash is not null or ino is not null)').rowcount
+    if orphans > 0:
+        logging.info(f'{orphans} duplicates lost their archived copy')
+
+
+def do_cyclic(fullname: str, digest: 'bytes | None', idx: 'int | None'):
+    global blacklist, excluding, counts
+    if fullname in run_names or (fullname, idx) in run_names:
+        # archived by the incremental backup of this run
+        return
     try:
-        for bl_item in blacklist:
-            if fullname.startswith(bl_item):
-                counts['removed'] += 1
-                remove_file(fullname)
-                return
+        if blacklist.covers(fullname):
+            counts['removed'] += 1
+            remove_file(fullname)
+            return
         stat_buf = os.lstat(fullname)
         if stat.S_ISDIR(stat_buf.st_mode):
             ext_fullname = fullname + '/'
         else:
             ext_fullname = fullname
-        for pattern in excluding:
-            m = pattern.search(ext_fullname)
-            if m is not None:
-                counts['removed'] += 1
-                remove_file(fullname)
-                return
+        if excluding.search(ext_fullname):
+            counts['removed'] += 1
+            remove_file(fullname)
+            return
         if stat.S_ISSOCK(stat_buf.st_mode):
             return
         mtime = int(stat_buf.st_mtime)
+        if idx is not None:
+            # a large file in use keeps its chunks, the next incremental backup takes the changed ones
+            if mtime <= max_age:
+                recycle_chunk(fullname, stat_buf, idx, digest)
+            return
         if mtime > max_age:
             counts['removed'] += 1
             remove_file(fullname)
             return
-        if target_sc.reserve(stat_buf.st_size):
-            logging.debug(f"backing up {fullname} {len(tarring)}")
-            counts['cyclic'] += 1
-            # remove leading '/' so tar does not complain
-            fullname = fullname[1:]
-            f2 = fullname
-            while f2.endswith(os.path.sep):
-                f2 = f2[:-1]
-            with set_lock:
-                tarring.add(f2)
-            print(fullname, file=tar_proc.stdin, flush=True)
+        admit(fullname, stat_buf, 'cyclic', digest)
     except FileNotFoundError:
         counts['removed'] += 1
         remove_file(fullname)
 
 
+def scan_dir(path: str, flag: str) -> tuple[list[os.DirEntry], list[os.DirEntry]]:
+    """
+    lists a directory into subdirectories and other entries, sorted by name;
+    the lstat result is cached in each entry;
+    a directory holding the exclude flag is returned as just the flag
+    """
+    with timed('walk') as phase:
+        dirs = []
+        files = []
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+            phase.add(items=len(entries))
+        except OSError as ex:
+            logging.warning(f'cannot list {path}: {ex}')
+            return dirs, files
+        for entry in entries:
+            if entry.name == flag:
+                return [], [entry]
+        for entry in entries:
+            try:
+                entry.stat(follow_symlinks=False)
+            except OSError:
+                # vanished since listing
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry)
+            else:
+                files.append(entry)
+        dirs.sort(key=lambda e: e.name)
+        files.sort(key=lambda e: e.name)
+        return dirs, files
+
+
+def scan_tree(top: str, pool: ThreadPoolExecutor, lookahead: int, flag: str):
+    """
+    walks top down like os.walk, yielding (path, dirs, files) with DirEntry lists in a deterministic order;
+    the next directories in walk order are listed ahead on the pool,
+    and removing entries from dirs keeps them from being walked
+    """
+    stack = [[top, pool.submit(scan_dir, top, flag)]]
+    while len(stack) > 0:
+        path, future = stack.pop()
+        if future is None:
+            future = pool.submit(scan_dir, path, flag)
+        dirs, files = future.result()
+        yield path, dirs, files
+        for entry in reversed(dirs):
+            stack.append([entry.path, None])
+        for item in stack[-lookahead:]:
+            if item[1] is None:
+                item[1] = pool.submit(scan_dir, item[0], flag)
+
+
+def backup_dir(path: str, dirs: list[os.DirEntry], files: list[os.DirEntry], flag: str, known_flags: set[str],
+               seen_flags: set[str]) -> 'list[os.DirEntry] | None':
+    """
+    backs up the entries of a directory listed by scan_dir, returns the subdirectories to walk into,
+    None once the volumes are full
+    """
+    with timed('incremental') as phase:
+        phase.add(items=len(files) + len(dirs))
+        if any(item.name == flag for item in files):
+            # scan_dir stopped at the flag, nothing below gets listed
+            blacklist.add(path)
+            counts['pruned'] += 1
+            seen_flags.add(path)
+            if path not in known_flags:
+                catalog.flagged(path, True)
+            return []
+        catalog_index.prefetch([item.path for item in files + dirs])
+        for item in files:
+            do_incremental(item.path, item.stat(follow_symlinks=False))
+            if volumes_full():
+                return None
+        descend = []
+        for item in dirs:
+            if item.path in known_flags:
+                seen_flags.add(item.path)
+                if os.path.lexists(os.path.join(item.path, flag)):
+                    blacklist.add(item.path)
+                    counts['pruned'] += 1
+                    continue
+                known_flags.discard(item.path)
+                catalog.flagged(item.path, False)
+            if excluding.search(item.path + os.path.sep):
+                # a directory matching an exclude pattern takes its subtree with it
+                blacklist.add(item.path)
+                counts['excluded'] += 1
+                counts['pruned'] += 1
+                continue
+            descend.append(item)
+            do_incremental(item.path, item.stat(follow_symlinks=False))
+            if volumes_full():
+                return None
+        return descend
+
+
+def backup_tree(top: str, scan_pool: ThreadPoolExecutor, flag: str, known_flags: set[str],
+                seen_flags: set[str]) -> bool:
+    """
+    walks a tree backing up what is new or changed, False if the volumes got full before the end
+    """
+    for path, dirs, files in scan_tree(top, scan_pool, 4 * int(config['scan_threads']), flag):
+        descend = backup_dir(path, dirs, files, flag, known_flags, seen_flags)
+        if descend is None:
+            return False
+        dirs[:] = descend
+    return True
+
+
+def read_journal() -> 'list[tuple[str, int, float]] | None':
+    """
+    the directories pywatch.py journaled with whether to walk below them, None if the whole tree is to be walked:
+    the watcher is not running for these roots, may have missed events since the last complete full walk,
+    or that walk is older than full_walk_interval
+    """
+    if not config['journal']:
+        counts['walk'] = 'full walk'
+        return None
+    row = db_conn.execute('select roots, started, beat, overflowed, walked from watcher').fetchone()
+    now = time.time()
+    if row is None:
+        reason = 'no watcher'
+    elif row[0] != '\n'.join(config['backup']):
+        reason = 'the watcher has other roots'
+    elif now - row[2] > 3 * float(config['watch_beat']):
+        reason = 'the watcher stopped'
+    elif row[4] is None or row[4] < max(row[1], row[3]):
+        reason = 'the watcher (re)started or lost events since the last full walk'
+    elif now - row[4] > float(config['full_walk_interval']):
+        reason = 'full walk due'
+    else:
+        return db_conn.execute('select path, deep, noted from journal order by path').fetchall()
+    logging.info(f'walking the whole tree: {reason}')
+    counts['walk'] = f'full walk, {reason}'
+    return None
+
+
+def backup_journaled(journal: list[tuple[str, int, float]], scan_pool: ThreadPoolExecutor, flag: str,
+                     known_flags: set[str], seen_flags: set[str]) -> bool:
+    """
+    backs up the directories of the journal instead of walking the trees, those created or moved in with all
+    below them; entries below those are covered by their walk, a directory whose parent is listed as well by
+    that listing; False if the volumes got full before the end
+    """
+    global start_device
+    # flagged directories stay skipped while they hold the flag, those that lost it are walked in full
+    for name in sorted(known_flags):
+        if os.path.lexists(os.path.join(name, flag)):
+            blacklist.add(name)
+            counts['pruned'] += 1
+        else:
+            known_flags.discard(name)
+            catalog.flagged(name, False)
+            journal.append((name, 1, None))
+    # the deep entry of a path first, the others of it are covered
+    journal.sort(key=lambda entry: (entry[0], -entry[1]))
+    deep_paths = set(path for path, deep, _ in journal if deep)
+    listed = set(path for path, _, _ in journal)
+    taken = set()
+    roots = sorted(config['backup'], key=len, reverse=True)
+    for path, deep, noted in journal:
+        parent = path
+        covered = path in taken
+        while not covered and os.path.dirname(parent) != parent:
+            parent = os.path.dirname(parent)
+            covered = parent in deep_paths
+        if covered:
+            # walked with a deep entry above it or of the same path
+            if noted is not None:
+                journal_done.append((path, noted))
+            continue
+        taken.add(path)
+        root = next((root for root in roots if path == root or path.startswith(root.rstrip(os.path.sep) + os.path.sep)),
+                    None)
+        try:
+            stat_buf = os.lstat(path)
+        except OSError:
+            # gone, the cyclic backup drops its files from the catalog
+            stat_buf = None
+        if root is not None and stat_buf is not None and stat.S_ISDIR(stat_buf.st_mode):
+            start_device = os.lstat(root).st_dev
+            # the walk would not have got here past an excluded or flagged directory
+            parents = [path]
+            while parents[-1] != root and len(parents[-1]) > len(root):
+                parents.append(os.path.dirname(parents[-1]))
+            if not blacklist.covers(path) and not any(excluding.search(parent + os.path.sep) for parent in parents
+                                                      if parent != root):
+                if path != root and os.path.dirname(path) not in listed:
+                    do_incremental(path, stat_buf)
+                if deep:
+                    if not backup_tree(path, scan_pool, flag, known_flags, seen_flags):
+                        return False
+                elif backup_dir(path, *scan_dir(path, flag), flag, known_flags, seen_flags) is None:
+                    return False
+        if noted is not None:
+            journal_done.append((path, noted))
+    return True
+
+
+def settle_journal():
+    """
+    drops the journal entries this run dealt with, after a complete full walk all noted before it started;
+    directories with files left for later are journaled for the next run. Nothing is dropped if a volume failed
+    """
+    if not config['journal'] or not all(volume.complete for volume in volumes):
+        return
+    now = time.time()
+    with db_conn:
+        if walk_started > 0:
+            db_conn.execute('update watcher set walked=?', (walk_started,))
+            db_conn.execute('delete from journal where noted<?', (walk_started,))
+        else:
+            db_conn.executemany('delete from journal where path=? and noted=?', journal_done)
+        db_conn.executemany('insert into journal(path, deep, noted) values(?,0,?) on conflict(path) do nothing',
+                            ((path, now) for path in unsettled))
+
+
+def unsettle(fullname: str):
+    """
+    remembers that a file was left for a later run, its directory stays in the journal
+    """
+    unsettled.add(os.path.dirname(fullname))
+
+
 def do_backup():
-    global tar_proc, config, blacklist, excluding, start_device, max_age, target_sc, tarring, vol_num
+    global config, blacklist, excluding, start_device, max_age, first_vol, catalog_index, hasher, chunk_above, \
+        walk_started
+    scan_pool = ThreadPoolExecutor(max_workers=int(config['scan_threads']), thread_name_prefix='scan')
     try:
-        for pattern in config['exclude']:
-            comp_pattern = re.compile(pattern)
-            excluding.append(comp_pattern)
+        excluding = PathMatcher(config['exclude'])
+        blacklist = PathTrie()
+        repoint_duplicates()
+        if config['hashing']:
+            hasher = Hasher()
+        chunk_above = parse_size(config['chunk_above'], 0)
+        if chunk_above > 0 and config['archiver'] != 'python':
+            # tar archives whole files only
+            logging.warning('chunk_above needs archiver python, large files are archived whole')
+            chunk_above = 0
+        catalog_index = CatalogIndex(db_conn)
         max_age = time.time() - config['min_age']
+        flag = config['exclude_flag']
+        # directories flagged in earlier runs are skipped without listing them
+        known_flags = set(row[0] for row in db_conn.execute('select name from flagged'))
+        seen_flags = set()
         # start incremental backup
         logging.debug('backing up new/changed files')
-        for entry in config['backup']:
-            stat_buf = os.lstat(entry)
-            start_device = stat_buf.st_dev
-            for path, dirs, files in os.walk(entry):
-                for item in files:
-                    if item == config['exclude_flag']:
-                        blacklist[path] = True
-                        continue
-                    fullname = os.path.join(path, item)
-                    do_incremental(fullname)
-                    if target_sc.is_filled():
-                        return
-                for item in dirs:
-                    fullname = os.path.join(path, item)
-                    do_incremental(fullname)
-                    if target_sc.is_filled():
-                        return
-        # end incremental backup
-        # start cyclic backup
-        logging.debug('starting cycling backup')
-        rs = db_conn.execute('select name, volume  from files where volume < ? order by volume ASC', (vol_num,))
-        while True:
-            row = rs.fetchone()
-            if row is None:
+        journal = read_journal()
+        if journal is not None:
+            counts['walk'] = f'journal, {len(journal)} directories'
+            if not backup_journaled(journal, scan_pool, flag, known_flags, seen_flags):
                 return
-            do_cyclic(row[0])
-            if target_sc.is_filled():
+        else:
+            started = time.time()
+            for entry in config['backup']:
+                stat_buf = os.lstat(entry)
+                start_device = stat_buf.st_dev
+                if not backup_tree(entry, scan_pool, flag, known_flags, seen_flags):
+                    return
+            # the walk was complete, flags not met again are gone
+            for name in known_flags - seen_flags:
+                catalog.flagged(name, False)
+            walk_started = started
+        if hasher is not None:
+            for hashed in hasher.ready(True):
+                settle_hashed(*hashed)
+                if volumes_full():
+                    return
+        # files that did not fit get further volumes
+        while len(deferred) > 0 and len(open_volumes) > 0:
+            if not roll_volume(max(open_volumes, key=lambda v: v.size_check.reserved)):
                 return
+        # end incremental backup
+        # start cyclic backup, filling the open volumes
+        logging.debug('starting cycling backup')
+        with timed('cyclic') as phase:
+            for name, digest, idx in plan_cyclic():
+                phase.add(items=1)
+                do_cyclic(name, digest, idx)
+                if all(volume.size_check.is_filled() for volume in open_volumes):
+                    return
         # end cyclic backup
     except Exception as e:
         logging.error("exception", e)
         exit(2)
     finally:
-        logging.debug(f"backup finished - {len(tarring)} unfinished")
+        scan_pool.shutdown(cancel_futures=True)
+        if hasher is not None:
+            hasher.close()
+        logging.debug(f"backup finished - {len(deferred)} deferred")
+
+
+def write_metrics():
+    """
+    writes the timings of the phases and stages with the counts of the run to metrics_json, and as gauges to
+    metrics_prom; the latter is renamed into place, so the collector never reads half of it
+    """
+    numbers = {name: value for name, value in counts.items() if isinstance(value, (int, float))}
+    if config['metrics_json']:
+        with open(config['metrics_json'], 'w') as f:
+            json.dump({'finished': time.time(), 'host': platform.node(), 'counts': numbers,
+                       'phases': counts['phases'], 'stages': counts['stages']}, f, indent=1)
+    if not config['metrics_prom']:
+        return
+    lines = [f'pybackup_last_run_timestamp_seconds {time.time():.0f}']
+    lines += [f'pybackup_{name} {value}' for name, value in sorted(numbers.items())]
+    for phase in counts['phases']:
+        for key in ('wall', 'cpu', 'count'):
+            lines.append(f'pybackup_phase_{key}{"_seconds" if key != "count" else ""}{{phase="{phase["name"]}"}} '
+                         f'{phase[key]}')
+    for stage in counts['stages']:
+        for key in ('seconds', 'cpu', 'bytes_in', 'bytes_out', 'exit'):
+            if stage[key] is not None:
+                lines.append(f'pybackup_stage_{key}{"_seconds" if key == "cpu" else ""}'
+                             f'{{stage="{stage["name"]}"}} {stage[key]}')
+    temp_name = config['metrics_prom'] + '.tmp'
+    with open(temp_name, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temp_name, config['metrics_prom'])
 
 
 def main():
@@ -394,7 +3060,8 @@ def main():
         -s <size> -- size of the archive file at max (<number>{k,m,M,g,G})
         -t <target> -- write archive to this file
     """
-    global config, defaultCfg, db_conn, tar_proc, enc_proc, xz_proc, target_file, target_sc, counts, tarring
+    global config, defaultCfg, db_conn, counts, catalog, first_vol, reader_pool, sparse_files, readahead, low_impact, \
+        throttle, frame_size
     config = yaml.safe_load(defaultCfg)
     opts, arg = getopt.getopt(sys.argv[1:], 'c:t:l:dhs:')
     for opt, opt_arg in opts:
@@ -417,67 +3084,86 @@ def main():
     logging.basicConfig(filename=config['log'], level=logging.DEBUG, filemode='w',
                         format='%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d %(funcName)s:\t%(message)s')
     logging.debug("pybackup started")
-    tar_args = ['tar', '-cv', '--no-recursion','--verbatim-file-from', '-T', '-']
-    enc_args = ['gpg', '-c', '--symmetric', '--batch', '--cipher-algo', 'TWOFISH', '--passphrase', config['key']]
-    xz_args = ['xz', '-9']
-    target_fn = config['target']
-    target_fn = target_fn.replace('%h', platform.node())
-    dt = datetime.datetime.now()
-    target_fn = target_fn.replace('%t', dt.strftime('%y-%m-%d_%H-%M-%S'))
-    with sqlite3.connect(config['db'], check_same_thread=False) as db_conn:
+    run_started = time.monotonic()
+    low_impact = bool(config['low_impact'])
+    if low_impact:
+        lower_priority()
+    with open_database(config['db']) as db_conn:
         prep_database()
-        db_conn.execute('insert into backup(num,tarfile) values(?,?)', (vol_num, target_fn))
-        db_conn.commit()
-        with open(target_fn, 'wb') as target_file:
-            target_sc = SizeCheck(config['max_target_size'], target_file.fileno())
-            tar_proc = subprocess.Popen(tar_args, cwd='/', stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE,
-                                        encoding='UTF-8', bufsize=0)
-            enc_proc = subprocess.Popen(enc_args, stdin=tar_proc.stdout, stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE, bufsize=0)
-            xz_proc = subprocess.Popen(xz_args, stdin=enc_proc.stdout, stdout=target_file, stderr=subprocess.PIPE,
-                                       bufsize=0)
-            with ThreadPoolExecutor(max_workers=7) as tpe:
-                tpe.submit(handle_tar_stderr)
-                tpe.submit(handle_enc_errors)
-                tpe.submit(handle_xz_errors)
-                do_backup()
-                old_size = -1
-                new_size = 1
-                old_cnt = -1
-                new_cnt = 1
-                while old_size != new_size or old_cnt != new_cnt:
-                    old_size = new_size
-                    old_cnt = new_cnt
-                    time.sleep(5)
-                    new_size = os.fstat(target_file.fileno()).st_size
-                    new_cnt = len(tarring)
-                    logging.debug(f"new size {new_size} - tarring {new_cnt}")
-                tar_proc.stdin.close()
-                p, e = os.wait()
-                logging.debug(f"waiting returned {p} {e}")
-                logging.debug("tar proc finished")
-                tar_proc.stderr.flush()
-                tar_proc.stderr.close()
-                enc_proc.wait()
-                xz_proc.wait()
-                logging.debug("tpe ending")
-            logging.debug("threads finished")
-        logging.debug(f"tar file closed - {len(tarring)}")
-        for fn in tarring:
-            logging.debug(f" not yet {fn}")
-        for row in db_conn.execute('select b.num,b.tarfile, count(f.name) from backup as b left join'
-                                   + ' files as f on b.num=f.volume group by b.num'):
+        first_vol = vol_num
+        catalog = CatalogWriter(config['db'])
+        started = time.monotonic()
+        pipelines = min(int(config['pipelines']), int(config['max_volumes']))
+        sparse_files = bool(config['sparse'])
+        frame_size = parse_size(config['frame_size'], 0)
+        if frame_size > 0 and config['archiver'] != 'python':
+            # tar does not tell where its members lie in the archive
+            logging.warning('frame_size needs archiver python, volumes are written as one stream')
+            frame_size = 0
+        limit_lag()
+        if int(config['read_window']) > 1:
+            readahead = ThreadPoolExecutor(max_workers=1, thread_name_prefix='readahead')
+        io_limit = parse_size(config['io_limit'], 0)
+        if io_limit > 0 or float(config['max_io_pressure']) > 0 or float(config['max_load']) > 0:
+            throttle = Throttle(io_limit, float(config['max_io_pressure']), float(config['max_load']))
+        with ThreadPoolExecutor(max_workers=3 * pipelines + 1) as reader_pool:
+            for _ in range(pipelines):
+                if new_volume() is None:
+                    break
+            do_backup()
+            for volume in open_volumes:
+                volume.close()
+        if readahead is not None:
+            readahead.shutdown(cancel_futures=True)
+        if throttle is not None:
+            throttle.close()
+            counts['throttled'] = throttle.paused
+            counts['lowest_rate'] = throttle.lowest
+        logging.debug("threads finished")
+        counts['bytes_out'] = sum(volume.size for volume in volumes)
+        counts['throughput'] = counts['bytes_in'] / max(time.monotonic() - started, 0.001)
+        counts['ratio'] = counts['bytes_out'] / counts['bytes_in'] if counts['bytes_in'] > 0 else 1.0
+        counts['filled'] = counts['bytes_out'] / max(sum(volume.target for volume in volumes), 1)
+        stage_times = {}
+        for volume in volumes:
+            for report in volume.stage_reports:
+                total = stage_times.setdefault(report['name'], {'name': report['name'], 'seconds': 0.0, 'exit': 0,
+                                                                'cpu': 0.0, 'bytes_in': 0, 'bytes_out': 0})
+                total['seconds'] += report['seconds']
+                total['exit'] = report['exit'] or total['exit']
+                total['cpu'] = None if report['cpu'] is None or total['cpu'] is None else total['cpu'] + report['cpu']
+                total['bytes_in'] += report['bytes_in']
+                total['bytes_out'] += report['bytes_out']
+        counts['stages'] = list(stage_times.values())
+        counts['volumes'] = volumes
+        catalog.close()
+        settle_journal()
+        repoint_duplicates()
+        counts['reclaimable'] = sorted((volume for volume in volume_usage(vol_num) if volume['reclaimable'] > 0),
+                                       key=lambda v: -v['reclaimable'])
+        # duplicates and chunks keep the volume holding their content
+        for row in db_conn.execute('select b.num, b.tarfile, (select count(*) from files where volume=b.num) '
+                                   '+ (select count(*) from files where src=b.num) '
+                                   '+ (select count(*) from chunks where volume=b.num) from backup as b'):
             if int(row[2]) == 0:
                 msg_list.append(f'tarfile {row[1]} from backup {row[0]} can be deleted')
                 db_conn.execute('delete from backup where num=?', (row[0],))
+                db_conn.execute('delete from frames where volume=?', (row[0],))
                 db_conn.commit()
     counts['errors'] = error_list
     counts['msgs'] = msg_list
+    counts['compression'] = config['compression']
+    counts['phases'] = [phase.report() for phase in phases.values()]
+    counts['run_seconds'] = time.monotonic() - run_started
+    counts['run_cpu'] = time.process_time()
     result_txt = config['resultT']
     templ = jinja2.Template(result_txt)
     result_txt = templ.render(counts)
     logging.debug(result_txt)
+    try:
+        write_metrics()
+    except OSError as ex:
+        logging.error(f'cannot write the metrics: {ex}')
 
 
 if __name__ == '__main__':
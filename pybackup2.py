@@ -28,6 +28,8 @@ db: /tmp/pybackup.db
 split: 5
 max_age: 300
 exclude_flag: ".bkexclude"
+# run tar at the lowest CPU and the idle I/O priority and drop the files it read from the page cache
+low_impact: false
 email:
     server: localhost
     subject: Result from pybackup
@@ -136,10 +138,18 @@ cnt_cyclic = 0
 cnt_flagged_exc = 0
 cnt_backed_up = 0
 cnt_removed = 0
+archived_rows: list[tuple] = []
+"""files reported by tar, written to the db once tar has finished"""
+removed_rows: list[tuple] = []
+"""files to delete from the db"""
 error_list: list[str] = []
 msg_list: list[str] = []
 
 
+SPLIT_PATHS_VERSION = 5
+"""first catalog version without files.name"""
+
+
 def prep_database():
     """
     prepares the database
@@ -166,6 +176,13 @@ def prep_database():
         for stmt in schemaStmts:
             db_conn.execute(stmt)
         db_conn.commit()
+    if version >= SPLIT_PATHS_VERSION:
+        # pybackup.py stores files by directory id and base name from this version on
+        msg = (f"the catalog {cfg['db']} is at version {version}, written by pybackup.py; "
+               f"pybackup2.py only reads catalogs before version {SPLIT_PATHS_VERSION}")
+        logging.error(msg)
+        print(msg, file=sys.stderr)
+        sys.exit(1)
     row = db_conn.execute('select max(volume) from files').fetchone()
     if row is not None and row[0] is not None:
         vol_num = row[0] + 1
@@ -217,12 +234,8 @@ def do_incremental(fullname: str, dev: int):
 def remove_file(fullname: str):
     global cnt_removed
     with db_lock:
-        try:
-            db_conn.execute('delete from files where name=?', (fullname,))
-            db_conn.commit()
-            cnt_removed += 1
-        except Exception as ex:
-            logging.error(f'exception {ex}')
+        removed_rows.append((fullname,))
+        cnt_removed += 1
 
 
 def do_cyclic(fullname: str, vol: int):
@@ -303,23 +316,45 @@ def do_backup():
 def handle_finished():
     global db_lock, vol_num, cnt_backed_up
     logging.debug('reading tar output')
+    # tar reports a file when starting it, so it is done with the one before
+    last = None
     try:
         while True:
             line = tar_proc.stdout.readline()
             if not line:
                 break
             line = '/' + line.strip()
+            if cfg['low_impact'] and last is not None:
+                drop_cache(last)
+            last = line
             statbuf = os.lstat(line)
             mtime = int(statbuf.st_mtime)
             with db_lock:
-                db_conn.execute('replace into files(name,mtime,volume) values(?,?,?)', (line, mtime, vol_num))
-                db_conn.commit()
+                archived_rows.append((line, mtime, vol_num))
                 cnt_backed_up += 1
     except Exception as ex:
         print('exception in handle_finish: %s', ex)
+    if cfg['low_impact'] and last is not None:
+        drop_cache(last)
     logging.debug('reading tar output stopped')
 
 
+def drop_cache(fullname: str):
+    """
+    asks the kernel to drop a file from the page cache
+    """
+    try:
+        fd = os.open(fullname, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
 def handle_errors():
     global error_list
     logging.debug('reading tar errors')
@@ -333,6 +368,19 @@ def handle_errors():
     logging.debug('reading tar errors stopped')
 
 
+def update_catalog():
+    """
+    writes the collected changes in one transaction, archived files only if tar succeeded
+    """
+    tar_proc.wait()
+    with db_conn:
+        if tar_proc.returncode in (0, 1):
+            db_conn.executemany('replace into files(name,mtime,volume) values(?,?,?)', archived_rows)
+        else:
+            error_list.append(f'tar exited with {tar_proc.returncode}, archived files are not recorded')
+        db_conn.executemany('delete from files where name=?', removed_rows)
+
+
 def main():
     """
     Use: pybackup <cfg-file> <target tar file>
@@ -356,7 +404,10 @@ def main():
         excludes.append(cpt)
     with sqlite3.connect(cfg['db'], check_same_thread=False) as _dbcon:
         db_conn = _dbcon
+        db_conn.execute('pragma journal_mode=wal')
         pcs = ['tar', '-cavf', tar_file, '-C', '/', '--no-recursion', '-T', '-']
+        if cfg['low_impact']:
+            pcs = ['ionice', '-c', '3', 'nice', '-n', '19'] + pcs
         prep_database()
         db_conn.execute('insert into backup(num,tarfile) values(?,?)', (vol_num, tar_file))
         db_conn.commit()
@@ -366,6 +417,7 @@ def main():
             exec.submit(do_backup)
             exec.submit(handle_finished)
             exec.submit(handle_errors)
+        update_catalog()
         for row in db_conn.execute('select b.num,b.tarfile, count(f.name) from backup as b left join'
                                    + ' files as f on b.num=f.volume group by b.num'):
             if int(row[2]) == 0:
@@ -0,0 +1,458 @@
+#!/bin/env python3
+import datetime
+import getopt
+import json
+import math
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures.thread import ThreadPoolExecutor
+
+import yaml
+
+import pybackup
+
+tree_params = {
+    'files': 20000,
+    'depth': 4,
+    'sizes': '1k:70,16k:25,256k:5',
+    'flags': 0.01,
+    'links': 0.02,
+    'seed': 1,
+}
+"""shape of the synthetic tree: file count, directory depth, size classes with their weights, share of directories
+holding the exclude flag, share of files that are further hard links, and the seed making it reproducible"""
+tree_dir = ''
+"""where the synthetic tree is built, a temporary directory if empty"""
+FILES_PER_DIR = 20
+"""files per directory the fan-out of the synthetic tree aims at"""
+MANIFEST = '.pybench.json'
+"""parameters of a built tree, in its top directory; a tree with the same ones is used again"""
+
+
+def random_word(rnd: random.Random, length: int = 6) -> str:
+    return ''.join(rnd.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def synthetic_paths(rnd: random.Random, count: int) -> list[str]:
+    """
+    paths looking like a home directory tree
+    """
+    return [f'/home/{random_word(rnd, 4)}/proj{rnd.randint(0, 100)}/src/mod{rnd.randint(0, 1000)}/file{i}.py'
+            for i in range(count)]
+
+
+def tree_name(i: int, per_dir: int = 20) -> str:
+    """
+    the i-th name of a deep tree with per_dir entries in each directory
+    """
+    d = i // per_dir
+    return f'/srv/data/user{d % 97}/project{d // 97 % 53}/build/src{d // 5141}/module_{d % 13}/file_{i % per_dir}.dat'
+
+
+def per_path_ns(paths: list[str], check) -> float:
+    start = time.perf_counter()
+    for path in paths:
+        check(path)
+    return (time.perf_counter() - start) / len(paths) * 1e9
+
+
+def bench_matcher(paths: int):
+    """
+    per path cost of the exclude patterns and flagged directories against their number,
+    compared with testing them one after another
+    """
+    rnd = random.Random(1)
+    sample = synthetic_paths(rnd, paths)
+    results = []
+    print(f"{'entries':>8} {'matcher':>10} {'re loop':>10} {'trie':>10} {'prefixes':>10}   (ns per path)")
+    for n in (1, 10, 100, 1000, 10000):
+        patterns = []
+        for i in range(n):
+            if i % 3 == 0:
+                patterns.append(f'/{random_word(rnd)}/')
+            elif i % 3 == 1:
+                patterns.append(f'\\.{random_word(rnd, 3)}$')
+            else:
+                patterns.append(f'{random_word(rnd)}\\.tmp')
+        flagged = [f'/home/{random_word(rnd, 4)}/proj{rnd.randint(0, 100)}/cache{i}' for i in range(n)]
+        matcher = pybackup.PathMatcher(patterns)
+        trie = pybackup.PathTrie()
+        for directory in flagged:
+            trie.add(directory)
+        compiled = [re.compile(pattern) for pattern in patterns]
+        # the loops get a smaller sample, they are slow for long lists
+        loop_sample = sample[:max(100, len(sample) * 10 // n)]
+        t_matcher = per_path_ns(sample, matcher.search)
+        t_patterns = per_path_ns(loop_sample, lambda p: any(c.search(p) is not None for c in compiled))
+        t_trie = per_path_ns(sample, trie.covers)
+        t_flagged = per_path_ns(loop_sample, lambda p: any(p.startswith(d) for d in flagged))
+        print(f"{n:>8} {t_matcher:>10.0f} {t_patterns:>10.0f} {t_trie:>10.0f} {t_flagged:>10.0f}")
+        results.append({'entries': n, 'matcher_ns': t_matcher, 're_loop_ns': t_patterns, 'trie_ns': t_trie,
+                         'prefixes_ns': t_flagged})
+    return {'paths': paths, 'rows': results}
+
+
+def bench_migrate(paths: int):
+    """
+    catalog size and lookup cost before and after splitting the names into directories and base names,
+    and the time the migration takes
+    """
+    rnd = random.Random(1)
+    # the scan looks up all entries of a directory in a row
+    sample = [tree_name(d * 20 + i) for d in sorted(rnd.sample(range(paths // 20), min(500, paths // 20))) for i in range(20)]
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, 'catalog.db')
+        conn = pybackup.open_database(db_file)
+        pybackup.db_conn = conn
+        upgrades = pybackup.schema_upgrades
+        pybackup.schema_upgrades = {version: stmts for version, stmts in upgrades.items() if version < 5}
+        try:
+            pybackup.prep_database()
+        except sqlite3.OperationalError:
+            # a catalog of version 4 has no chunks table to find the next volume number in
+            pass
+        pybackup.schema_upgrades = upgrades
+        with conn:
+            conn.executemany('insert into files(name, mtime, volume, size) values(?,?,?,?)',
+                             ((tree_name(i), 1600000000 + i, i % 30, i % 100000) for i in range(paths)))
+        conn.execute('pragma wal_checkpoint(TRUNCATE)')
+        size_before = os.path.getsize(db_file)
+        t_before = per_path_ns(sample, lambda name: conn.execute('select mtime, volume from files where name=?',
+                                                                 (name,)).fetchone())
+        start = time.perf_counter()
+        pybackup.prep_database()
+        t_migrate = time.perf_counter() - start
+        conn.execute('pragma wal_checkpoint(TRUNCATE)')
+        size_after = os.path.getsize(db_file)
+        index = pybackup.CatalogIndex(conn)
+        t_after = per_path_ns(sample, index.lookup)
+        dirs = conn.execute('select count(*) from dirs').fetchone()[0]
+        conn.close()
+    print(f"{'rows':>10} {'dirs':>8} {'MB before':>10} {'MB after':>10} {'migration':>10} "
+          f"{'ns before':>10} {'ns after':>10}")
+    print(f"{paths:>10} {dirs:>8} {size_before / 1e6:>10.1f} {size_after / 1e6:>10.1f} {t_migrate:>9.1f}s "
+          f"{t_before:>10.0f} {t_after:>10.0f}")
+    return {'rows': paths, 'dirs': dirs, 'bytes_before': size_before, 'bytes_after': size_after,
+            'migration_s': t_migrate, 'lookup_before_ns': t_before, 'lookup_after_ns': t_after}
+
+
+def size_classes() -> tuple[list[int], list[float]]:
+    """
+    sizes and weights of tree_params['sizes'], given as size:weight,...
+    """
+    sizes = []
+    weights = []
+    for item in tree_params['sizes'].split(','):
+        size, _, weight = item.partition(':')
+        sizes.append(pybackup.parse_size(size, 0))
+        weights.append(float(weight or 1))
+    return sizes, weights
+
+
+def synthetic_tree(top: str) -> tuple[list[str], list[str], list[tuple[str, int, 'str | None']]]:
+    """
+    directories, flagged directories and files of the synthetic tree below top, the same for the same
+    tree_params; files are (path, size, name of the file it is a further hard link of or None)
+    """
+    rnd = random.Random(tree_params['seed'])
+    count = int(tree_params['files'])
+    depth = max(int(tree_params['depth']), 1)
+    fanout = max(2, math.ceil((count / FILES_PER_DIR) ** (1 / depth)))
+    dirs = [top]
+    level = [top]
+    for _ in range(depth):
+        level = [os.path.join(parent, f'd{random_word(rnd, 3)}{i}') for parent in level
+                 for i in range(rnd.randint(1, 2 * fanout - 1))]
+        dirs.extend(level)
+    flagged = sorted(rnd.sample(dirs[1:], min(round(float(tree_params['flags']) * len(dirs)), len(dirs) - 1)))
+    sizes, weights = size_classes()
+    files = []
+    regular = []
+    for i in range(count):
+        path = os.path.join(rnd.choice(dirs), f'f{i}_{random_word(rnd, 4)}')
+        if len(regular) > 0 and rnd.random() < float(tree_params['links']):
+            source = files[rnd.choice(regular)]
+            files.append((path, source[1], source[0]))
+        else:
+            regular.append(len(files))
+            files.append((path, int(rnd.choices(sizes, weights)[0] * rnd.uniform(0.5, 1.5)), None))
+    return dirs, flagged, files
+
+
+def build_tree() -> str:
+    """
+    writes the synthetic tree into tree_dir unless it holds one with the same parameters; the content is
+    pseudo random from the seed, so the compression ratio is that of incompressible data, and all entries
+    get fixed mtimes in the past
+    """
+    top = tree_dir or os.path.join(tempfile.gettempdir(), 'pybench-tree')
+    manifest = os.path.join(top, MANIFEST)
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            if json.load(f) == tree_params:
+                return top
+        # only a tree of ours is replaced
+        shutil.rmtree(top)
+    elif os.path.exists(top) and len(os.listdir(top)) > 0:
+        print(f'{top} is not empty and holds no synthetic tree', file=sys.stderr)
+        sys.exit(1)
+    started = time.perf_counter()
+    dirs, flagged, files = synthetic_tree(top)
+    for path in dirs:
+        os.makedirs(path, exist_ok=True)
+    for path in flagged:
+        open(os.path.join(path, pybackup.config['exclude_flag']), 'w').close()
+    rnd = random.Random(tree_params['seed'])
+    for n, (path, size, source) in enumerate(files):
+        if source is not None:
+            os.link(source, path)
+            continue
+        with open(path, 'wb') as f:
+            left = size
+            while left > 0:
+                block = rnd.randbytes(min(left, 1024 * 1024))
+                f.write(block)
+                left -= len(block)
+        os.utime(path, (1600000000 + n, 1600000000 + n))
+    for path in reversed(dirs):
+        os.utime(path, (1600000000, 1600000000))
+    with open(manifest, 'w') as f:
+        json.dump(tree_params, f)
+    print(f'built {len(files)} files in {len(dirs)} directories below {top} in {time.perf_counter() - started:.1f}s')
+    return top
+
+
+def populate_catalog(conn, files: list[tuple[str, int, 'str | None']], rows: int, volumes: int = 30):
+    """
+    fills a catalog of the current schema with the files of the synthetic tree and as many more rows of a deep tree,
+    spread over volumes, each with its row in the backup table
+    """
+    pybackup.db_conn = conn
+    pybackup.prep_database()
+    entries = [(path, 1600000000 + n, n % volumes, size) for n, (path, size, _) in enumerate(files)]
+    entries += [(tree_name(i), 1600000000 + i, i % volumes, i % 100000) for i in range(rows)]
+    dir_ids = {}
+    written = [0] * volumes
+    for _, _, volume, size in entries:
+        written[volume] += size
+    with conn:
+        for path, _, _, _ in entries:
+            directory = os.path.dirname(path)
+            if directory not in dir_ids:
+                dir_ids[directory] = conn.execute('insert into dirs(path) values(?)', (directory,)).lastrowid
+        conn.executemany('insert into files(dir_id, base, mtime, volume, size) values(?,?,?,?,?)',
+                         ((dir_ids[os.path.dirname(path)], os.path.basename(path), mtime, volume, size)
+                          for path, mtime, volume, size in entries))
+        conn.executemany('insert into backup(num, tarfile, bytes, size, started) values(?,?,?,?,?)',
+                         ((volume, f'/tmp/bench-{volume}.tar.xz.gpg', written[volume], written[volume],
+                           1600000000 + volume) for volume in range(volumes)))
+    pybackup.prep_database()
+    return entries
+
+
+def bench_walk(paths: int):
+    """
+    listing the synthetic tree the way the incremental backup does, with one and with scan_threads listing ahead;
+    directories holding the exclude flag are not walked below
+    """
+    top = build_tree()
+    flag = pybackup.config['exclude_flag']
+    results = []
+    print(f"{'threads':>8} {'dirs':>8} {'entries':>9} {'seconds':>8} {'entries/s':>10}")
+    for threads in sorted({1, int(pybackup.config['scan_threads'])}):
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            started = time.perf_counter()
+            dirs = entries = 0
+            for path, subdirs, files in pybackup.scan_tree(top, pool, 4 * threads, flag):
+                dirs += 1
+                entries += len(subdirs) + len(files)
+            seconds = time.perf_counter() - started
+        print(f"{threads:>8} {dirs:>8} {entries:>9} {seconds:>8.2f} {entries / seconds:>10.0f}")
+        results.append({'threads': threads, 'dirs': dirs, 'entries': entries, 'seconds': seconds})
+    return {'rows': results}
+
+
+def bench_lookup(paths: int):
+    """
+    catalog lookups of the files of the synthetic tree, directory by directory as the scan does, in a catalog with
+    paths more rows; preloaded into memory and queried per directory
+    """
+    _, _, files = synthetic_tree(tree_dir or os.path.join(tempfile.gettempdir(), 'pybench-tree'))
+    names = sorted(path for path, _, _ in files)
+    by_dir = {}
+    for name in names:
+        by_dir.setdefault(os.path.dirname(name), []).append(name)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = pybackup.open_database(os.path.join(tmp, 'catalog.db'))
+        populate_catalog(conn, files, paths)
+        print(f"{'preload':>8} {'rows':>9} {'load s':>8} {'ns/path':>8}")
+        for preload in (False, True):
+            pybackup.config['db_preload'] = preload
+            started = time.perf_counter()
+            index = pybackup.CatalogIndex(conn)
+            t_load = time.perf_counter() - started
+            started = time.perf_counter()
+            for directory, entries in by_dir.items():
+                index.prefetch(entries)
+                for name in entries:
+                    index.lookup(name)
+            t_lookup = (time.perf_counter() - started) / len(names) * 1e9
+            print(f"{str(preload):>8} {len(files) + paths:>9} {t_load:>8.2f} {t_lookup:>8.0f}")
+            results.append({'preload': preload, 'rows': len(files) + paths, 'load_s': t_load, 'lookup_ns': t_lookup})
+        conn.close()
+    return {'rows': results}
+
+
+def bench_cyclic(paths: int):
+    """
+    selecting a volume of max_target_size for the cyclic backup from a catalog of the synthetic tree and
+    paths more rows, as the planner does while the volume fills up
+    """
+    _, _, files = synthetic_tree(tree_dir or os.path.join(tempfile.gettempdir(), 'pybench-tree'))
+    budget = pybackup.parse_size(pybackup.config['max_target_size'], 0)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = pybackup.open_database(os.path.join(tmp, 'catalog.db'))
+        entries = populate_catalog(conn, files, paths)
+        sizes = {path: size for path, _, _, size in entries}
+        pybackup.first_vol = pybackup.vol_num
+        room = [budget]
+        pybackup.cyclic_room = lambda: room[0]
+        started = time.perf_counter()
+        selected = 0
+        for name, digest, idx in pybackup.plan_cyclic():
+            room[0] -= sizes[name] + pybackup.HEADER_SZ
+            selected += 1
+        seconds = time.perf_counter() - started
+        conn.close()
+    print(f"{'rows':>9} {'volume MB':>10} {'selected':>9} {'seconds':>8}")
+    print(f"{len(entries):>9} {budget / 1e6:>10.0f} {selected:>9} {seconds:>8.2f}")
+    return {'rows': len(entries), 'budget': budget, 'selected': selected, 'seconds': seconds}
+
+
+def bench_archive(paths: int):
+    """
+    pybackup runs on the synthetic tree with the merged config: the first archives all of it into one volume,
+    the second finds nothing changed and gets a volume of 1M, which the cyclic backup fills quickly, so it times
+    the walk and the catalog checks; each run is a process of its own
+    """
+    top = build_tree()
+    _, flagged, files = synthetic_tree(top)
+    data = sum(size for path, size, source in files
+               if source is None and not any(path.startswith(d + os.path.sep) for d in flagged))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        config = dict(pybackup.config)
+        config.update({'db': os.path.join(tmp, 'catalog.db'), 'log': os.path.join(tmp, 'pybackup.log'),
+                       'target': os.path.join(tmp, 'volume-%n.tar%z.gpg'), 'backup': [top], 'min_age': 0,
+                       'max_volumes': 1})
+        config_file = os.path.join(tmp, 'config.yaml')
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pybackup.py')
+        print(f"{'run':>10} {'data MB':>8} {'volume MB':>10} {'seconds':>8} {'MB/s':>7}")
+        for run, target_size in (('initial', max(2 * data, 1 << 30)), ('unchanged', 1 << 20)):
+            config['max_target_size'] = target_size
+            with open(config_file, 'w') as f:
+                yaml.safe_dump(config, f)
+            before = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp)
+                         if name.startswith('volume-'))
+            started = time.perf_counter()
+            subprocess.run([sys.executable, script, '-c', config_file], check=True, stdout=subprocess.DEVNULL)
+            seconds = time.perf_counter() - started
+            written = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp)
+                          if name.startswith('volume-')) - before
+            archived = data if run == 'initial' else 0
+            print(f"{run:>10} {archived / 1e6:>8.1f} {written / 1e6:>10.1f} {seconds:>8.2f} "
+                  f"{archived / 1e6 / seconds:>7.1f}")
+            results.append({'run': run, 'data': archived, 'written': written, 'seconds': seconds})
+    return {'archiver': config['archiver'], 'compression': config['compression'], 'rows': results}
+
+
+benchmarks = {
+    'matcher': bench_matcher,
+    'migrate': bench_migrate,
+    'walk': bench_walk,
+    'lookup': bench_lookup,
+    'cyclic': bench_cyclic,
+    'archive': bench_archive,
+}
+
+
+def main():
+    """
+    Use: pybench { options } [ benchmark ... ]
+      options:
+        -c <config> -- merge with this pybackup config
+        -h -- display help
+        -o <file> -- save the results as JSON
+        -p <number> -- paths per measurement, rows of the catalog besides the synthetic tree
+        -t <dir> -- build the synthetic tree here, a tree built with the same parameters is used again
+        -T <param>=<value> -- shape of the synthetic tree: files, depth, sizes (size:weight,...),
+                              flags (share of directories with the exclude flag), links (share of hard links), seed
+      benchmarks: matcher, migrate (-p rows of the catalog), walk, lookup, cyclic, archive (on the synthetic tree)
+    """
+    global tree_dir
+    paths = 20000
+    output = None
+    pybackup.config = yaml.safe_load(pybackup.defaultCfg)
+    opts, args = getopt.getopt(sys.argv[1:], 'c:ho:p:t:T:')
+    for opt, opt_arg in opts:
+        if opt == '-c':
+            with open(opt_arg) as cf:
+                pybackup.config.update(yaml.safe_load(cf))
+        elif opt == '-h':
+            print(main.__doc__)
+            sys.exit(2)
+        elif opt == '-o':
+            output = opt_arg
+        elif opt == '-p':
+            paths = int(opt_arg)
+        elif opt == '-t':
+            tree_dir = os.path.abspath(opt_arg)
+        elif opt == '-T':
+            param, _, value = opt_arg.partition('=')
+            if param not in tree_params:
+                print(f'unknown tree parameter {param}', file=sys.stderr)
+                sys.exit(2)
+            tree_params[param] = type(tree_params[param])(value)
+    if len(args) == 0:
+        args = list(benchmarks)
+    for name in args:
+        if name not in benchmarks:
+            print(f'unknown benchmark {name}', file=sys.stderr)
+            sys.exit(2)
+    started = datetime.datetime.now().isoformat(timespec='seconds')
+    results = {}
+    failed = False
+    for name in args:
+        print(f'### {name}')
+        try:
+            results[name] = benchmarks[name](paths)
+        except Exception as ex:
+            # the other benchmarks still run, the error goes into the results
+            traceback.print_exc()
+            results[name] = {'error': f'{type(ex).__name__}: {ex}'}
+            failed = True
+        if output is not None:
+            # saved after each benchmark, so a long run that breaks off keeps what it measured
+            with open(output, 'w') as f:
+                json.dump({'started': started, 'host': platform.node(),
+                           'python': platform.python_version(), 'paths': paths, 'tree': tree_params,
+                           'config': {key: pybackup.config[key] for key in ('archiver', 'compression',
+                                                                             'compression_level', 'scan_threads')},
+                           'results': results}, f, indent=1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
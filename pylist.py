@@ -0,0 +1,169 @@
+#!/bin/env python3
+import getopt
+import os
+import sqlite3
+import sys
+import time
+
+import yaml
+
+import pybackup
+
+LAST = '\U0010ffff'
+"""sorts after every character, closes the range of names starting with a prefix"""
+WILDCARDS = '*?['
+
+FILES = ('select d.path, f.base, f.volume, f.src, f.size, f.mtime from files as f '
+         'join dirs as d on d.id=f.dir_id ')
+"""catalog entry of a file, the conditions follow"""
+NAME = "rtrim(d.path, '/') || '/' || f.base"
+"""full name of a file in the queries"""
+
+
+def format_entry(path: str, base: str, volume: 'int | None', src: 'int | None', size: 'int | None',
+                 mtime: float) -> str:
+    """
+    one line per file: volume, size, mtime and name; a duplicate or link shows the volume holding its content
+    after '=', a file archived in chunks shows 'chunks'
+    """
+    if volume is not None:
+        where = str(volume)
+    elif src is not None:
+        where = f'={src}'
+    else:
+        where = 'chunks'
+    when = time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime)) if mtime >= 0 else '-'
+    return f'{where:>7} {size or 0:>13} {when} {os.path.join(path, base)}'
+
+
+def emit(rows):
+    for row in rows:
+        print(format_entry(*row))
+
+
+def where(conn: sqlite3.Connection, name: str):
+    """
+    the volume holding a file, and those holding its chunks
+    """
+    row = conn.execute(FILES + 'where d.path=? and f.base=?', os.path.split(name)).fetchone()
+    if row is None:
+        print(f'{name}: not in the catalog', file=sys.stderr)
+        return
+    print(format_entry(*row))
+    if row[2] is None and row[3] is None:
+        for idx, volume, size in conn.execute('select c.idx, c.volume, c.size from chunks as c join dirs as d '
+                                              'on d.id=c.dir_id where d.path=? and c.base=? order by c.idx',
+                                              os.path.split(name)):
+            print(f'{volume:>7} {size:>13} chunk {idx}')
+
+
+def find(conn: sqlite3.Connection, pattern: str):
+    """
+    files matching a glob pattern, '*' matches across directories; a pattern without wildcards stands for the
+    name and everything below it. The part before the first wildcard narrows the search by the indexes of the
+    directories and the base names, a pattern starting with a wildcard reads the whole catalog
+    """
+    wildcards = [pattern.find(c) for c in WILDCARDS if c in pattern]
+    if len(wildcards) == 0:
+        name = pattern.rstrip(os.path.sep) or os.path.sep
+        below = name.rstrip(os.path.sep) + os.path.sep
+        emit(conn.execute(FILES + 'where d.path=? and f.base=?', os.path.split(name)))
+        emit(conn.execute(FILES + 'where d.path=? or (d.path>=? and d.path<?)', (name, below, below + LAST)))
+        return
+    prefix = pattern[:min(wildcards)]
+    if not prefix.startswith(os.path.sep):
+        emit(conn.execute(FILES + f'where {NAME} glob ?', (pattern,)))
+        return
+    head, tail = os.path.split(prefix)
+    if head != prefix:
+        # files in the directory of the prefix, by the entry index
+        emit(conn.execute(FILES + f'where d.path=? and f.base>=? and f.base<? and {NAME} glob ?',
+                          (head, tail, tail + LAST, pattern)))
+    # files in the directories starting with the prefix, by the unique index of the paths
+    emit(conn.execute(FILES + f'where d.path>=? and d.path<? and {NAME} glob ?', (prefix, prefix + LAST, pattern)))
+
+
+def since(conn: sqlite3.Connection, volume: int):
+    """
+    files changed after the run writing volume started; they went into that volume or later ones,
+    as files, duplicates or chunks, so the volume indexes find them
+    """
+    row = conn.execute('select started from backup where num=?', (volume,)).fetchone()
+    if row is None:
+        print(f'volume {volume} is not in the backup table', file=sys.stderr)
+        return
+    started = row[0]
+    if started is None:
+        # written before the catalog kept the start of volumes
+        print(f'volume {volume} has no start time, listing all files archived since', file=sys.stderr)
+        started = -1
+    emit(conn.execute(FILES + 'where f.volume>=? and f.mtime>?', (volume, started)))
+    emit(conn.execute(FILES + 'where f.src>=? and f.mtime>?', (volume, started)))
+    emit(conn.execute('select distinct d.path, f.base, f.volume, f.src, f.size, f.mtime from chunks as c '
+                      'join files as f on f.dir_id=c.dir_id and f.base=c.base join dirs as d on d.id=f.dir_id '
+                      'where c.volume>=? and f.volume is null and f.src is null and f.mtime>?', (volume, started)))
+
+
+def list_volume(conn: sqlite3.Connection, volume: int):
+    """
+    the files and chunks archived in a volume, and the duplicates and links whose content it holds
+    """
+    emit(conn.execute(FILES + 'where f.volume=?', (volume,)))
+    for path, base, idx, size in conn.execute('select d.path, c.base, c.idx, c.size from chunks as c '
+                                              'join dirs as d on d.id=c.dir_id where c.volume=?', (volume,)):
+        print(f'{volume:>7} {size:>13} chunk {idx:<10} {os.path.join(path, base)}')
+    emit(conn.execute(FILES + 'where f.src=?', (volume,)))
+
+
+def main():
+    """
+    Use: pylist { options } command argument ...
+      answers from the catalog, without reading the volumes
+      commands:
+        where <path> ... -- the volume holding each file, and its chunks
+        find <pattern> ... -- files matching a glob pattern, or everything below a path without wildcards
+        since <volume> -- files changed after the run writing this volume started
+        list <volume> -- files, chunks and the duplicates and links a volume holds the content of
+      options:
+        -c <config> -- merge with this config
+        -h -- display help
+      each file is listed as volume, size, mtime and name; '=n' is a duplicate or link restored from volume n,
+      'chunks' a file archived in chunks
+    """
+    config = yaml.safe_load(pybackup.defaultCfg)
+    opts, args = getopt.getopt(sys.argv[1:], 'c:h')
+    for opt, opt_arg in opts:
+        if opt == '-c':
+            with open(opt_arg) as cf:
+                config.update(yaml.safe_load(cf))
+        elif opt == '-h':
+            print(main.__doc__)
+            sys.exit(2)
+    commands = {'where': where, 'find': find, 'since': since, 'list': list_volume}
+    if len(args) < 2 or args[0] not in commands:
+        print(main.__doc__)
+        sys.exit(2)
+    pybackup.config = config
+    conn = pybackup.open_database(config['db'])
+    version = conn.execute('select max(version) from dbv').fetchone()[0]
+    if version < max(pybackup.schema_upgrades):
+        print(f'the catalog is at version {version}, pybackup upgrades it on its next run', file=sys.stderr)
+        sys.exit(1)
+    command = commands[args[0]]
+    try:
+        for arg in args[1:]:
+            if command in (since, list_volume):
+                command(conn, int(arg))
+            elif command is where or arg[0] not in WILDCARDS:
+                # names are absolute in the catalog, a pattern starting with a wildcard matches anywhere
+                command(conn, os.path.abspath(arg))
+            else:
+                command(conn, arg)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # the reader stopped early, as head does; nothing left to flush at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+#!/bin/env python3
+import bisect
+import contextlib
+import getopt
+import io
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tarfile
+from concurrent.futures.thread import ThreadPoolExecutor
+
+import yaml
+
+import pybackup
+
+decompression = {'.xz': ['xz', '-dc'], '.zst': ['zstd', '-dcq']}
+"""command decompressing the volumes of each suffix"""
+
+
+def target_path(out: str, name: str) -> str:
+    return os.path.join(out, name.lstrip(os.path.sep))
+
+
+def find_files(conn: sqlite3.Connection, name: str) -> list[tuple]:
+    """
+    catalog rows of a file or of everything below a directory
+    """
+    select = ('select d.path, f.base, f.volume, f.src, f.hash, f.size, f.mtime, f.dev, f.ino, f.pos, f.length '
+              'from files as f join dirs as d on d.id=f.dir_id ')
+    rows = conn.execute(select + 'where d.path=? and f.base=?', os.path.split(name)).fetchall()
+    below = name.rstrip(os.path.sep)
+    # '0' follows '/', the range holds the paths below
+    rows += conn.execute(select + 'where d.path=? or (d.path>=? and d.path<?)',
+                         (below, below + '/', below + '0')).fetchall()
+    return rows
+
+
+def plan(conn: sqlite3.Connection, rows: list[tuple]) \
+        -> tuple[dict[int, dict[str, list[tuple]]], dict[int, dict[str, tuple]], dict[str, tuple]]:
+    """
+    the members to read from each volume with the names to restore them as and whether as hard links,
+    where the members lie in framed volumes, and size and mtime of the files restored from chunks;
+    a name None only provides the content for others
+    """
+    wanted = {}
+    spans = {}
+    chunked = {}
+
+    def want(volume: int, member: str, name: 'str | None', link: bool = False, pos: 'int | None' = None,
+             length: 'int | None' = None):
+        member = member.lstrip(os.path.sep)
+        wanted.setdefault(volume, {}).setdefault(member, []).append((name, link))
+        if pos is not None:
+            spans.setdefault(volume, {})[member] = (pos, length)
+
+    def want_links(volume: int, dev: int, ino: int):
+        # tar stores the content with the first name of a file, the others as links to it
+        for path, base, pos, length in conn.execute('select d.path, f.base, f.pos, f.length from files as f '
+                                                    'join dirs as d on d.id=f.dir_id '
+                                                    'where f.ino=? and f.dev=? and f.volume=?', (ino, dev, volume)):
+            want(volume, os.path.join(path, base), None, False, pos, length)
+
+    for path, base, volume, src, digest, size, mtime, dev, ino, pos, length in rows:
+        name = os.path.join(path, base)
+        if volume is not None:
+            want(volume, name, name, ino is not None, pos, length)
+            if ino is not None:
+                want_links(volume, dev, ino)
+        elif src is not None:
+            # a duplicate or hard link, restored from the copy archived under another name
+            if digest is not None:
+                row = conn.execute('select d.path, f.base, f.pos, f.length from files as f '
+                                   'join dirs as d on d.id=f.dir_id '
+                                   'where f.hash=? and f.volume=? limit 1', (digest, src)).fetchone()
+            else:
+                row = conn.execute('select d.path, f.base, f.pos, f.length from files as f '
+                                   'join dirs as d on d.id=f.dir_id '
+                                   'where f.ino=? and f.dev=? and f.volume=? limit 1', (ino, dev, src)).fetchone()
+            if row is None:
+                print(f'{name}: the copy of its content is gone', file=sys.stderr)
+                continue
+            want(src, os.path.join(row[0], row[1]), name, digest is None, row[2], row[3])
+            if ino is not None:
+                want_links(src, dev, ino)
+        else:
+            chunks = conn.execute('select idx, volume, pos, length from chunks '
+                                  'where dir_id=(select id from dirs where path=?) and base=?', (path, base)).fetchall()
+            if len(chunks) == 0:
+                print(f'{name}: not in any volume', file=sys.stderr)
+                continue
+            chunked[name] = (size, int(mtime))
+            for idx, chunk_volume, pos, length in chunks:
+                want(chunk_volume, pybackup.chunk_name(name, idx), name, False, pos, length)
+    return wanted, spans, chunked
+
+
+def suffix_of(tarfile_name: str) -> str:
+    """
+    suffix of the compression in the name of a volume
+    """
+    if not tarfile_name.endswith('.gpg'):
+        raise ValueError(f'{tarfile_name}: volumes encrypted after compression are not supported')
+    return os.path.splitext(tarfile_name[:-len('.gpg')])[1]
+
+
+def open_volume(tarfile_name: str, key: str) -> list[subprocess.Popen]:
+    """
+    starts gpg and the decompression reading a volume, the last process gives the archive
+    """
+    suffix = suffix_of(tarfile_name)
+    with open(tarfile_name, 'rb') as src:
+        procs = [subprocess.Popen(['gpg', '-d', '--batch', '--passphrase', key], stdin=src,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)]
+    if suffix in decompression:
+        procs.append(subprocess.Popen(decompression[suffix], stdin=procs[0].stdout, stdout=subprocess.PIPE))
+        procs[0].stdout.close()
+    return procs
+
+
+def stream_members(tarfile_name: str, key: str):
+    """
+    the members of a volume, reading it from the start
+    """
+    procs = open_volume(tarfile_name, key)
+    try:
+        with tarfile.open(fileobj=procs[-1].stdout, mode='r|') as tf:
+            for info in tf:
+                yield tf, info
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+
+
+class FrameReader:
+    """
+    reads parts of the archive of a framed volume, decrypting and decompressing only the frames holding them
+    """
+
+    def __init__(self, tarfile_name: str, frames: list[tuple[int, int, int, int]], key: str):
+        self.file = open(tarfile_name, 'rb')
+        self.frames = frames
+        """position and length in the archive, start and size in the volume file of each frame, by position"""
+        self.starts = [frame[0] for frame in frames]
+        self.key = key
+        self.decompress = decompression.get(suffix_of(tarfile_name))
+        self.cached = (-1, b'')
+        """the frame decoded last, members following each other mostly share it"""
+
+    def frame(self, idx: int) -> bytes:
+        if self.cached[0] == idx:
+            return self.cached[1]
+        _, _, start, size = self.frames[idx]
+        self.file.seek(start)
+        sealed = self.file.read(size)
+        magic, length = pybackup.FRAME_HEADER.unpack_from(sealed)
+        if magic != pybackup.FRAME_MAGIC or length != size - pybackup.FRAME_HEADER.size:
+            raise ValueError(f'{self.file.name}: no frame at {start}')
+        data = subprocess.run(['gpg', '-d', '--batch', '--passphrase', self.key],
+                              input=sealed[pybackup.FRAME_HEADER.size:], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout
+        if self.decompress is not None:
+            data = subprocess.run(self.decompress, input=data, stdout=subprocess.PIPE, check=True).stdout
+        self.cached = (idx, data)
+        return data
+
+    def read(self, pos: int, length: int) -> bytes:
+        parts = []
+        idx = bisect.bisect_right(self.starts, pos) - 1
+        while length > 0 and 0 <= idx < len(self.frames):
+            frame_pos = self.frames[idx][0]
+            data = self.frame(idx)[pos - frame_pos:pos - frame_pos + length]
+            parts.append(data)
+            pos += len(data)
+            length -= len(data)
+            idx += 1
+        return b''.join(parts)
+
+    def close(self):
+        self.file.close()
+
+
+def indexed_members(tarfile_name: str, frames: list[tuple], spans: dict[str, tuple], key: str):
+    """
+    the wanted members of a framed volume in archive order, each read from the frames holding it
+    """
+    reader = FrameReader(tarfile_name, frames, key)
+    try:
+        for member, (pos, length) in sorted(spans.items(), key=lambda item: item[1][0]):
+            tf = tarfile.open(fileobj=io.BytesIO(reader.read(pos, length)), mode='r:')
+            info = tf.next()
+            if info is None:
+                print(f'{member}: no member at {pos} of {tarfile_name}', file=sys.stderr)
+                continue
+            yield tf, info
+    finally:
+        reader.close()
+
+
+def extract(tf: tarfile.TarFile, info: tarfile.TarInfo, dest: str):
+    """
+    writes a member to dest, a chunk into its place in the file
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if pybackup.CHUNK_OFFSET in info.pax_headers:
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT, info.mode)
+        with os.fdopen(fd, 'wb') as f:
+            offset = int(info.pax_headers[pybackup.CHUNK_OFFSET])
+            if info.sparse is None:
+                f.seek(offset)
+                shutil.copyfileobj(tf.extractfile(info), f)
+                return
+            # the data extents of a sparse chunk only, the rest stays holes; volumes are read as a stream,
+            # the zeros of the holes are read past
+            src = tf.extractfile(info)
+            pos = 0
+            for start, size in info.sparse:
+                while pos < start and (block := src.read(min(start - pos, 1024 * 1024))):
+                    pos += len(block)
+                f.seek(offset + start)
+                while pos < start + size and (block := src.read(min(start + size - pos, 1024 * 1024))):
+                    f.write(block)
+                    pos += len(block)
+            if os.fstat(fd).st_size < offset + info.size:
+                f.truncate(offset + info.size)
+        return
+    if info.isdir():
+        os.makedirs(dest, exist_ok=True)
+        return
+    if os.path.lexists(dest) and not os.path.isdir(dest):
+        os.unlink(dest)
+    if info.issym():
+        os.symlink(info.linkname, dest)
+        return
+    if not info.isreg():
+        print(f'{dest}: skipped, {info.type} members are not restored', file=sys.stderr)
+        return
+    if info.sparse is not None:
+        # writes the data extents only, the rest stays holes
+        tf.makefile(info, dest)
+    else:
+        with open(dest, 'wb') as f:
+            shutil.copyfileobj(tf.extractfile(info), f)
+    os.chmod(dest, info.mode)
+    os.utime(dest, (info.mtime, info.mtime))
+
+
+def clear_chunked(out: str, chunked: dict[str, tuple]):
+    """
+    removes what is found where files restored from chunks go, the chunks are written into place and would leave
+    old bytes in the holes between them
+    """
+    for name in chunked:
+        dest = target_path(out, name)
+        if os.path.lexists(dest) and not os.path.isdir(dest):
+            os.unlink(dest)
+
+
+def place(source: str, dest: str, link: bool):
+    """
+    gives dest the content of a file restored before, as a hard link if link and possible
+    """
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    if link:
+        try:
+            os.link(source, dest)
+            return
+        except OSError:
+            pass
+    shutil.copy2(source, dest)
+
+
+def restore_volume(volume: int, tarfile_name: str, members: dict[str, list[tuple]], spans: dict[str, tuple],
+                   frames: list[tuple], out: str, key: str) -> int:
+    """
+    restores the wanted members of a volume, reading a framed volume only where they lie and others once
+    from the start; returns the number of names restored
+    """
+    if len(frames) > 0:
+        missing = [member for member in members if member not in spans]
+        for member in missing:
+            print(f'{member}: not indexed in {tarfile_name}', file=sys.stderr)
+            del members[member]
+        entries = indexed_members(tarfile_name, frames, spans, key)
+    else:
+        entries = stream_members(tarfile_name, key)
+    restored = 0
+    extracted = {}
+    """file holding the content of each member read"""
+    sources = []
+    """content of links nobody asked for, removed at the end"""
+    try:
+        with contextlib.closing(entries):
+            for tf, info in entries:
+                names = members.pop(info.name, None)
+                if names is None:
+                    continue
+                dests = [(target_path(out, name), link) for name, link in names if name is not None]
+                if info.islnk():
+                    first = extracted.get(info.linkname)
+                    if first is None:
+                        print(f'{info.name}: the content of the link is not in {tarfile_name}', file=sys.stderr)
+                        continue
+                elif len(dests) > 0:
+                    first = dests.pop(0)[0]
+                    extract(tf, info, first)
+                else:
+                    first = os.path.join(out, f'.pyrestore-{volume}-{len(sources)}')
+                    sources.append(first)
+                    extract(tf, info, first)
+                extracted[info.name] = first
+                # a member is read once, further names get the content restored first
+                for dest, link in dests:
+                    place(first, dest, link)
+                restored += len([name for name, _ in names if name is not None])
+                if len(members) == 0:
+                    break
+    finally:
+        for source in sources:
+            os.unlink(source)
+    for member, names in members.items():
+        if any(name is not None for name, _ in names):
+            print(f'{member}: not found in {tarfile_name}', file=sys.stderr)
+    return restored
+
+
+def main():
+    """
+    Use: pyrestore { options } path ...
+      restores files, or everything below directories, from the volumes the catalog names
+      options:
+        -c <config> -- merge with this config
+        -h -- display help
+        -j <jobs> -- volumes read at the same time (default: the number of cores)
+        -k -- set encryption key
+        -o <dir> -- restore below this directory (default .)
+    """
+    config = yaml.safe_load(pybackup.defaultCfg)
+    out = '.'
+    jobs = os.cpu_count() or 1
+    opts, args = getopt.getopt(sys.argv[1:], 'c:hj:k:o:')
+    for opt, opt_arg in opts:
+        if opt == '-c':
+            with open(opt_arg) as cf:
+                config.update(yaml.safe_load(cf))
+        elif opt == '-h':
+            print(main.__doc__)
+            sys.exit(2)
+        elif opt == '-j':
+            jobs = int(opt_arg)
+        elif opt == '-k':
+            config['key'] = opt_arg
+        elif opt == '-o':
+            out = opt_arg
+    pybackup.config = config
+    conn = pybackup.open_database(config['db'])
+    rows = []
+    for name in args:
+        rows += find_files(conn, os.path.abspath(name))
+    wanted, spans, chunked = plan(conn, rows)
+    clear_chunked(out, chunked)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        for volume in sorted(wanted):
+            row = conn.execute('select tarfile from backup where num=?', (volume,)).fetchone()
+            if row is None:
+                print(f'volume {volume} is not in the backup table', file=sys.stderr)
+                continue
+            frames = conn.execute('select pos, length, start, size from frames where volume=? order by pos',
+                                  (volume,)).fetchall()
+            futures.append(pool.submit(restore_volume, volume, row[0], wanted[volume], spans.get(volume, {}), frames,
+                                       out, config['key']))
+        restored = sum(future.result() for future in futures)
+    for name, (size, mtime) in chunked.items():
+        dest = target_path(out, name)
+        if os.path.exists(dest):
+            # a file whose last chunks are missing still gets its size
+            os.truncate(dest, size)
+            os.utime(dest, (mtime, mtime))
+    print(f'{restored} members restored into {out}')
+
+
+if __name__ == '__main__':
+    main()
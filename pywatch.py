@@ -0,0 +1,276 @@
+#!/bin/env python3
+import ctypes
+import ctypes.util
+import errno
+import getopt
+import logging
+import os
+import select
+import signal
+import sqlite3
+import struct
+import sys
+import time
+
+import yaml
+
+import pybackup
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+"""changes to the entries of a directory, and to the directory itself"""
+EVENT = struct.Struct('iIII')
+"""struct inotify_event without its name: wd, mask, cookie, len"""
+FLUSH_DELAY = 1.0
+"""seconds events are collected before they go into the journal"""
+
+
+class Watcher:
+    """
+    inotify watches on the directories below the backup roots, on the device of their root, skipping excluded
+    directories and those below an exclude flag; events are turned into the directories to list again
+    """
+
+    def __init__(self, roots: list[str], excluding: pybackup.PathMatcher, flag: str):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f'inotify_init1: {os.strerror(err)}')
+        self.roots = roots
+        self.devices = {root: os.lstat(root).st_dev for root in roots}
+        self.excluding = excluding
+        self.flag = flag
+        self.paths: dict[int, str] = {}
+        self.changed: dict[str, int] = {}
+        """directories to list again, 1 to walk all below them"""
+        self.overflowed = False
+        self.incomplete = False
+        """a watch could not be added, changes below it go unseen"""
+
+    def root_of(self, path: str) -> 'str | None':
+        for root in sorted(self.roots, key=len, reverse=True):
+            if path == root or path.startswith(root.rstrip(os.path.sep) + os.path.sep):
+                return root
+        return None
+
+    def watch(self, top: str):
+        """
+        watches top and the directories below it; adding a watch again only updates its path
+        """
+        root = self.root_of(top)
+        if root is None:
+            return
+        stack = [top]
+        while len(stack) > 0:
+            path = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    if not self.incomplete:
+                        logging.error(f'out of inotify watches at {path}, raise fs.inotify.max_user_watches; '
+                                      f'every backup walks the whole tree until pywatch restarts')
+                    self.incomplete = True
+                elif err not in (errno.ENOENT, errno.ENOTDIR):
+                    logging.warning(f'cannot watch {path}: {os.strerror(err)}')
+                continue
+            self.paths[wd] = path
+            try:
+                with os.scandir(path) as it:
+                    entries = list(it)
+            except OSError as ex:
+                logging.warning(f'cannot list {path}: {ex}')
+                continue
+            if any(entry.name == self.flag for entry in entries):
+                # the backup does not go below the flag, the watch tells when it is removed
+                continue
+            for entry in entries:
+                try:
+                    if not entry.is_dir(follow_symlinks=False) or \
+                            entry.stat(follow_symlinks=False).st_dev != self.devices[root]:
+                        continue
+                except OSError:
+                    continue
+                if not self.excluding.search(entry.path + os.path.sep):
+                    stack.append(entry.path)
+
+    def unwatch(self, top: str):
+        """
+        drops the watches of a directory moved away and those below it, a move into the tree adds them again
+        """
+        below = top + os.path.sep
+        for wd, path in list(self.paths.items()):
+            if path == top or path.startswith(below):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.paths[wd]
+
+    def note(self, path: str, deep: int = 0):
+        self.changed[path] = max(self.changed.get(path, 0), deep)
+
+    def read(self):
+        """
+        reads the pending events
+        """
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+            name = os.fsdecode(data[pos + EVENT.size:pos + EVENT.size + length].rstrip(b'\0'))
+            pos += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                logging.warning('inotify queue overflowed, the next backup walks the whole tree')
+                self.overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            path = self.paths.get(wd)
+            if path is None:
+                continue
+            if not name:
+                # the directory itself changed, its entry is listed in the parent
+                if mask & IN_ATTRIB and path not in self.roots:
+                    self.note(os.path.dirname(path))
+                continue
+            self.note(path)
+            fullname = os.path.join(path, name)
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                self.unwatch(fullname)
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                if not self.excluding.search(fullname + os.path.sep):
+                    self.note(fullname, 1)
+                    self.watch(fullname)
+            elif name == self.flag and mask & (IN_DELETE | IN_MOVED_FROM):
+                # the subtree below a removed flag is backed up again
+                self.note(path, 1)
+                self.watch(path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def journal(conn: sqlite3.Connection, watcher: Watcher) -> bool:
+    """
+    writes the changed directories into the journal and the heartbeat into the watcher row,
+    False if the catalog was busy and they wait for the next round
+    """
+    now = time.time()
+    try:
+        with conn:
+            conn.executemany('insert into journal(path, deep, noted) values(?, ?, ?) on conflict(path) do update '
+                             'set deep=max(deep, excluded.deep), noted=excluded.noted',
+                             ((path, deep, now) for path, deep in watcher.changed.items()))
+            if watcher.overflowed or watcher.incomplete:
+                conn.execute('update watcher set beat=?, overflowed=?', (now, now))
+            else:
+                conn.execute('update watcher set beat=?', (now,))
+    except sqlite3.OperationalError as ex:
+        logging.warning(f'cannot write the journal: {ex}')
+        return False
+    logging.debug(f'journaled {len(watcher.changed)} directories')
+    watcher.changed.clear()
+    watcher.overflowed = False
+    return True
+
+
+def main():
+    """
+    Use: pywatch { options }
+      watches the backup roots with inotify and journals the directories changed in them into the catalog,
+      so pybackup with journal: true lists only those instead of walking the whole tree
+      options:
+        -c <config> -- merge with this config
+        -h -- display help
+        -l <logfile> -- write to this logfile instead of stderr
+        -v -- log every journal write
+      pybackup walks the whole tree once after pywatch starts, when the kernel dropped events and when pywatch
+      is not running
+    """
+    config = yaml.safe_load(pybackup.defaultCfg)
+    opts, args = getopt.getopt(sys.argv[1:], 'c:hl:v')
+    log_file = None
+    level = logging.INFO
+    for opt, opt_arg in opts:
+        if opt == '-c':
+            with open(opt_arg) as cf:
+                config.update(yaml.safe_load(cf))
+        elif opt == '-h':
+            print(main.__doc__)
+            sys.exit(2)
+        elif opt == '-l':
+            log_file = opt_arg
+        elif opt == '-v':
+            level = logging.DEBUG
+    logging.basicConfig(filename=log_file, level=level,
+                        format='%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d %(funcName)s:\t%(message)s')
+    pybackup.config = config
+    conn = pybackup.open_database(config['db'])
+    version = conn.execute('select max(version) from dbv').fetchone()[0]
+    if version < max(pybackup.schema_upgrades):
+        print(f'the catalog is at version {version}, pybackup upgrades it on its next run', file=sys.stderr)
+        sys.exit(1)
+    # stopped by a signal, the heartbeat ends and the next backup walks the whole tree
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    watcher = Watcher(config['backup'], pybackup.PathMatcher(config['exclude']), config['exclude_flag'])
+    for root in config['backup']:
+        watcher.watch(root)
+    logging.info(f'watching {len(watcher.paths)} directories')
+    now = time.time()
+    # changes before the watches were in place are only found by a full walk after this
+    with conn:
+        conn.execute('insert into watcher(id, roots, started, beat, overflowed) values(1, ?, ?, ?, 0) '
+                     'on conflict(id) do update set roots=excluded.roots, started=excluded.started, '
+                     'beat=excluded.beat, overflowed=0', ('\n'.join(config['backup']), now, now))
+    beat = float(config['watch_beat'])
+    poll = select.poll()
+    poll.register(watcher.fd, select.POLLIN)
+    first_change = None
+    last_beat = now
+    try:
+        while True:
+            if first_change is not None:
+                timeout = max(first_change + FLUSH_DELAY - time.monotonic(), 0)
+            else:
+                timeout = max(last_beat + beat - time.time(), 0)
+            if poll.poll(timeout * 1000):
+                watcher.read()
+                if first_change is None and (watcher.changed or watcher.overflowed):
+                    first_change = time.monotonic()
+            due = first_change is not None and time.monotonic() - first_change >= FLUSH_DELAY
+            if due or time.time() - last_beat >= beat:
+                if journal(conn, watcher):
+                    first_change = None
+                    last_beat = time.time()
+                else:
+                    # retried once the catalog is free
+                    first_change = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        journal(conn, watcher)
+        with conn:
+            conn.execute('update watcher set beat=0')
+        watcher.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
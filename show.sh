@@ -4,5 +4,11 @@ exec 2>&1
 for F in $*
 do
   echo "### showing ${F}"
-  unxz <$F | gpg -d --passphrase "${PP}" --batch | tar tvf -
+  case "${F}" in
+    # volumes written before compression moved ahead of encryption
+    *.enc.xz) unxz <$F | gpg -d --passphrase "${PP}" --batch | tar tvf - ;;
+    *.xz.gpg) gpg -d --passphrase "${PP}" --batch <$F | unxz | tar tvf - ;;
+    *.zst.gpg) gpg -d --passphrase "${PP}" --batch <$F | zstd -dcq | tar tvf - ;;
+    *) gpg -d --passphrase "${PP}" --batch <$F | tar tvf - ;;
+  esac
 done
@@ -0,0 +1,46 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import pybackup
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.skipif(shutil.which('gpg') is None or shutil.which('tar') is None, reason='needs gpg and tar')
+def test_hard_link_in_the_same_run_while_hashing(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'a').mkdir(parents=True)
+    (src / 'b').mkdir()
+    (src / 'a' / 'hl1').write_bytes(os.urandom(100000))
+    os.link(src / 'a' / 'hl1', src / 'b' / 't1.txt')
+    for name in (src / 'a' / 'hl1', src / 'a', src / 'b', src):
+        os.utime(name, (1600000000, 1600000000))
+    cfg = tmp_path / 'cfg.yaml'
+    cfg.write_text(f'''log: {tmp_path}/pb.log
+db: {tmp_path}/pb.db
+target: {tmp_path}/backup-%n.tar%z.gpg
+compression: none
+key: topsecret
+hashing: true
+hash_min_size: 1K
+hash_workers: 1
+backup:
+  - {src}
+''')
+    subprocess.run([sys.executable, os.path.join(HERE, 'pybackup.py'), '-c', str(cfg)], cwd=tmp_path, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    conn = sqlite3.connect(tmp_path / 'pb.db')
+    rows = conn.execute('select f.base, f.volume, f.src, f.dev, f.ino from files as f join dirs as d '
+                        'on d.id=f.dir_id where f.base in (?, ?) order by f.base', ('hl1', 't1.txt')).fetchall()
+    conn.close()
+    stat_buf = os.stat(src / 'a' / 'hl1')
+    # both names archived into the volume, the second as a link to the first
+    assert [row[0] for row in rows] == ['hl1', 't1.txt']
+    for base, volume, src_volume, dev, ino in rows:
+        assert volume is not None and src_volume is None
+        assert (dev, ino) == pybackup.inode(stat_buf)
@@ -0,0 +1,24 @@
+import pybackup
+
+
+def test_inline_flags_kept_apart():
+    matcher = pybackup.PathMatcher(['(?i)\\.jpg$', 'fstab', '\\.git/'])
+    assert matcher.search('/home/me/Photo.JPG')
+    assert matcher.search('/etc/fstab')
+    assert matcher.search('/src/.git/')
+    assert not matcher.search('/home/me/photo.png')
+
+
+def test_named_groups_kept_apart():
+    matcher = pybackup.PathMatcher(['(?P<x>cache)/', '/(?P<x>tmp)/', 'bak$'])
+    assert matcher.search('/home/me/.cache/')
+    assert matcher.search('/var/tmp/x')
+    assert matcher.search('/etc/passwd.bak')
+    assert not matcher.search('/etc/passwd')
+
+
+def test_back_reference():
+    matcher = pybackup.PathMatcher(['/(\\w+)/\\1/', 'core$'])
+    assert matcher.search('/a/b/b/c')
+    assert matcher.search('/var/core')
+    assert not matcher.search('/a/b/c/d')
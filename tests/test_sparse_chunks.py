@@ -0,0 +1,54 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+import pybackup
+import pyrestore
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def sparse_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(pybackup, 'sparse_files', True)
+    name = str(tmp_path / 'disk.img')
+    with open(name, 'wb') as f:
+        f.truncate(3 * MB + 1000)
+        f.write(b'head' * 1024)
+        f.seek(MB + MB // 2)
+        f.write(b'middle' * 1024)
+    if not pybackup.is_sparse(os.stat(name)):
+        pytest.skip('no holes on this file system')
+    return name
+
+
+def test_sparse_file_above_chunk_threshold(sparse_file, tmp_path):
+    size = os.stat(sparse_file).st_size
+    out = io.BytesIO()
+    writer = pybackup.TarWriter.__new__(pybackup.TarWriter)
+    digests = []
+    with tarfile.open(fileobj=out, mode='w', format=tarfile.PAX_FORMAT) as tf:
+        for idx, offset in enumerate(range(0, size, MB)):
+            digests.append(writer.write_chunk(tf, sparse_file, idx, offset, min(MB, size - offset)))
+    # the holes are not in the archive
+    assert out.tell() < MB
+    for idx, offset in enumerate(range(0, size, MB)):
+        assert digests[idx] == pybackup.chunk_digest(sparse_file, offset, min(MB, size - offset))
+    out.seek(0)
+    # restored over an older copy, whose bytes must not show through the holes
+    dest = pyrestore.target_path(str(tmp_path / 'out'), sparse_file)
+    os.makedirs(os.path.dirname(dest))
+    with open(dest, 'wb') as f:
+        f.write(b'old' * size)
+    pyrestore.clear_chunked(str(tmp_path / 'out'), {sparse_file: (size, 0)})
+    names = [pybackup.chunk_name(sparse_file.lstrip(os.path.sep), idx) for idx in range(len(digests))]
+    with tarfile.open(fileobj=out, mode='r:') as tf:
+        for info in tf:
+            assert info.name == names.pop(0)
+            assert info.sparse is not None
+            pyrestore.extract(tf, info, dest)
+    with open(sparse_file, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
+    assert os.stat(dest).st_blocks < os.stat(sparse_file).st_size // 512